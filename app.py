@@ -1,11 +1,56 @@
-from flask import Flask, render_template_string, request, redirect, session
+from flask import Flask, Response, render_template, request, redirect, session, make_response, abort, g, jsonify
+from flask import has_request_context, before_render_template, template_rendered
 from flask_sqlalchemy import SQLAlchemy
+from jinja2 import DictLoader
+from sqlalchemy import event, insert, select, update, delete, text, bindparam
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, DataError
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.dialects import postgresql, sqlite
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+from flask import Request, send_file
 import os
-from datetime import datetime
+import re
+import uuid
+import hashlib
+import gzip
+import zlib
+import time
+import atexit
+import sqlite3
+import threading
+import math
+import io
+import csv
+import shutil
+import tempfile
+import mimetypes
+import random
+import struct
+import itertools
+import json
+import queue
+import click
+from datetime import date, datetime, timezone, timedelta
+from urllib.parse import quote
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Время старта процесса (для воркера gunicorn - момент fork), см. worker_started()
+_boot = {'started': time.perf_counter(), 'served': False}
 
 app = Flask(__name__)
 
+# Шаблоны страниц лежат в коде рядом со своими обработчиками; через загрузчик
+# Jinja компилирует каждый один раз, а warm_up() делает это ещё до fork
+TEMPLATES = {}
+app.jinja_loader = DictLoader(TEMPLATES)
+
 # Конфигурация для Render
 if 'RENDER' in os.environ:
     # На Render
@@ -13,13 +58,152 @@ if 'RENDER' in os.environ:
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL').replace("postgres://", "postgresql://", 1)
     app.config['UPLOAD_FOLDER'] = '/opt/render/project/src/static/videos'
 else:
-    # Локально
+    # Локально (база и папка переопределяются окружением, например для бенчмарков)
     app.config['SECRET_KEY'] = 'local-secret-key'
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///pixtube.db'
-    app.config['UPLOAD_FOLDER'] = 'static/videos'
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///pixtube.db')
+    app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', 'static/videos')
+
+# Схема и админ создаются командой init-db (её запускает деплой); локально для удобства
+# то же самое делается лениво перед первым запросом процесса
+app.config['AUTO_INIT_DB'] = os.environ.get('AUTO_INIT_DB', '0' if 'RENDER' in os.environ else '1') == '1'
+
+# Кэширование: страницы для анонимов короткое время живут в общих кэшах (CDN),
+# файлы видео - год, их имена уникальны и содержимое не меняется
+app.config['PAGE_CACHE_SECONDS'] = int(os.environ.get('PAGE_CACHE_SECONDS', 60))
+app.config['CHANNEL_PAGE_SIZE'] = 24
+app.config['MEDIA_CACHE_SECONDS'] = 365 * 24 * 3600
+# /media/<id>/<хэш ключа> проверяет блокировку, поэтому в кэше браузера живёт час
+app.config['MEDIA_PRIVATE_CACHE_SECONDS'] = 3600
+
+# Сжатие: мелкие ответы не трогаем, крупные сжимаем потоком по кускам
+app.config['COMPRESS_MIN_SIZE'] = 500
+app.config['COMPRESS_STREAM_SIZE'] = 256 * 1024
+app.config['COMPRESS_LEVEL'] = 6
+
+# Общее для всех воркеров gunicorn состояние (метрики и т.п.) - локальный файл SQLite
+app.config['SHARED_STATE_DB'] = os.environ.get('SHARED_STATE_DB', os.path.join(app.instance_path, 'shared.db'))
+
+# Метрики: воркер копит приращения в памяти и раз в несколько секунд сбрасывает их в общую базу
+app.config['METRICS_FLUSH_SECONDS'] = 5
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+# Профилирование SQL: медленные запросы пишутся в лог вместе с планом (EXPLAIN),
+# заголовок Server-Timing добавляется в debug-режиме или при SERVER_TIMING=1
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 100))
+app.config['SERVER_TIMING'] = os.environ.get('SERVER_TIMING') == '1'
+
+# Хранилище видео: 'local' (UPLOAD_FOLDER) или 's3' (любое S3-совместимое, например MinIO).
+# Для s3 нужен boto3, ключи берутся из стандартных переменных AWS_ACCESS_KEY_ID/AWS_SECRET_ACCESS_KEY
+app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'local')
+app.config['S3_BUCKET'] = os.environ.get('S3_BUCKET')
+app.config['S3_ENDPOINT_URL'] = os.environ.get('S3_ENDPOINT_URL')
+app.config['S3_REGION'] = os.environ.get('S3_REGION', 'us-east-1')
+app.config['S3_URL_TTL'] = int(os.environ.get('S3_URL_TTL', 900))
+
+# Отдача локальных файлов через обратный прокси: воркер только проверяет доступ, байты отдаёт
+# nginx ('x-accel', internal-локации по префиксам, пример в nginx.conf.example) или
+# Apache/lighttpd ('x-sendfile', абсолютный путь). Пусто - отдаёт сам Flask
+app.config['MEDIA_OFFLOAD'] = os.environ.get('MEDIA_OFFLOAD', '')
+app.config['MEDIA_ACCEL_PREFIX'] = os.environ.get('MEDIA_ACCEL_PREFIX', '/_media/')
+app.config['ARCHIVE_ACCEL_PREFIX'] = os.environ.get('ARCHIVE_ACCEL_PREFIX', '/_archive/')
+app.config['USE_X_SENDFILE'] = app.config['MEDIA_OFFLOAD'] == 'x-sendfile'
+
+# Загрузки: общий предел на запрос, предел на файл для обычных пользователей
+# и запас свободного места на диске, который загрузки не занимают
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', 500)) * 1024 * 1024
+app.config['USER_MAX_UPLOAD_BYTES'] = int(os.environ.get('USER_MAX_UPLOAD_MB', 100)) * 1024 * 1024
+app.config['UPLOAD_DISK_RESERVE'] = 50 * 1024 * 1024
+
+# Квоты: сколько байт видео может хранить обычный пользователь и вся платформа (0 - без ограничения)
+app.config['USER_QUOTA_BYTES'] = int(os.environ.get('USER_QUOTA_MB', 500)) * 1024 * 1024
+app.config['TOTAL_QUOTA_BYTES'] = int(os.environ.get('TOTAL_QUOTA_MB', 0)) * 1024 * 1024
+
+# Уровни хранения (только для локального хранилища): холодные видео уезжают из UPLOAD_FOLDER
+# в ARCHIVE_FOLDER (другой диск), пока горячий уровень больше HOT_TIER_MB или свободного
+# места меньше HOT_FREE_MB сверх запаса; при обращении видео возвращается обратно
+app.config['ARCHIVE_FOLDER'] = os.environ.get('ARCHIVE_FOLDER')
+app.config['HOT_TIER_BYTES'] = int(os.environ.get('HOT_TIER_MB', 700)) * 1024 * 1024
+app.config['HOT_FREE_BYTES'] = int(os.environ.get('HOT_FREE_MB', 200)) * 1024 * 1024
+app.config['TIERING_SECONDS'] = 3600
+app.config['TIERING_MIN_AGE'] = timedelta(days=1)
+
+# Проверка хранилища (команда sweep-uploads): файлы моложе SWEEP_MIN_AGE не трогаем -
+# загрузка могла сохранить файл, но ещё не записать строку в базу
+app.config['SWEEP_MIN_AGE'] = 3600
+
+# Просмотры в UserStats: воркер копит их по авторам в памяти и сбрасывает раз в
+# VIEWS_FLUSH_SECONDS, чтобы просмотры разных видео автора не ждали блокировку одной строки
+app.config['VIEWS_FLUSH_SECONDS'] = 10
+
+# Уникальные зрители (HyperLogLog): воркер копит скетчи в памяти и сливает их в базу;
+# дневные скетчи старше VIEWER_SKETCH_DAYS удаляются, общий ('all') остаётся
+app.config['VIEWERS_FLUSH_SECONDS'] = 10
+app.config['VIEWER_SKETCH_DAYS'] = 30
+app.config['VIEWERS_PRUNE_SECONDS'] = 3600
+
+# Журнал событий (просмотры, play, seek, лайки): воркер дописывает строки в свой сегмент,
+# сегмент закрывается по размеру или возрасту; сводки строит команда aggregate-events
+app.config['EVENT_LOG_DIR'] = os.environ.get('EVENT_LOG_DIR', os.path.join(app.instance_path, 'events'))
+app.config['EVENT_FLUSH_SECONDS'] = 2
+app.config['EVENT_BUFFER_LINES'] = 1000
+app.config['EVENT_SEGMENT_BYTES'] = 16 * 1024 * 1024
+app.config['EVENT_SEGMENT_SECONDS'] = 3600
+app.config['EVENT_SEGMENT_KEEP_DAYS'] = 7
+
+# Время просмотра: плеер раз в HEARTBEAT_INTERVAL секунд запоминает позицию и шлёт пачку
+# позиций; воркер складывает просмотренные секунды в памяти и сбрасывает их в базу
+app.config['HEARTBEAT_INTERVAL'] = 5
+app.config['HEARTBEAT_SEND_SECONDS'] = 30
+app.config['HEARTBEAT_FLUSH_SECONDS'] = 15
+# Больше, чем пачка может честно накопить за интервал отправки, одна пачка не засчитывает
+app.config['HEARTBEAT_MAX_SECONDS'] = 2 * app.config['HEARTBEAT_SEND_SECONDS']
+
+# Новые комментарии в реальном времени (SSE): воркер раз в COMMENT_FEED_POLL секунд читает
+# общую ленту и раздаёт новые строки подписчикам своего процесса. Соединение живёт не дольше
+# SSE_MAX_SECONDS, дальше браузер переподключается сам (нужен gthread, см. gunicorn.conf.py)
+app.config['COMMENT_FEED_POLL'] = 0.5
+app.config['COMMENT_FEED_KEEP_SECONDS'] = 600
+app.config['COMMENT_FEED_PRUNE_SECONDS'] = 600
+app.config['SSE_PING_SECONDS'] = 15
+app.config['SSE_MAX_SECONDS'] = 300
+# Открытых потоков на воркер - четверть потоков gunicorn, остальные зрители опрашивают
+app.config['SSE_MAX_STREAMS'] = int(os.environ.get('SSE_MAX_STREAMS',
+                                                   max(1, int(os.environ.get('GUNICORN_THREADS', 16)) // 4)))
+app.config['SSE_POLL_SECONDS'] = 15
+# Можно ли слушать видео (не заблокировано, автор не забанен) воркер помнит SSE_CHECK_SECONDS:
+# переподключения зрителей не ходят в основную базу, блокировка доходит до потоков с этой задержкой
+app.config['SSE_CHECK_SECONDS'] = 60
+app.config['SSE_CHECK_CACHE_SIZE'] = 10000
+
+# Сводки для панели администратора: раз в ROLLUP_SECONDS один воркер досчитывает
+# дни с последней сводки (и заодно разбирает закрытые сегменты журнала событий)
+app.config['ROLLUP_SECONDS'] = 600
+app.config['DASHBOARD_DAYS'] = 30
+app.config['TOP_VIDEOS_DAYS'] = 7
+
+# Ограничение частоты POST-запросов: endpoint -> (запас, запросов в минуту).
+# Корзины токенов лежат в общей базе, поэтому лимит общий для всех воркеров
+app.config['RATE_LIMITS'] = {
+    'add_comment': (5, 10),
+    'upload': (3, 5),
+    'login': (5, 10),
+    'register': (3, 5),
+    'heartbeat': (10, 30),
+}
+app.config['RATE_LIMIT_ENABLED'] = os.environ.get('RATE_LIMIT_ENABLED', '1') == '1'
+app.config['RATE_LIMIT_PRUNE_SECONDS'] = 600
+
+# За прокси Render адрес клиента приходит в X-Forwarded-For
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 1 if 'RENDER' in os.environ else 0))
+if app.config['TRUSTED_PROXIES']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'], x_proto=app.config['TRUSTED_PROXIES'])
 
 # Создаем папку для видео если её нет
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(os.path.dirname(app.config['SHARED_STATE_DB']), exist_ok=True)
+if app.config['ARCHIVE_FOLDER']:
+    os.makedirs(app.config['ARCHIVE_FOLDER'], exist_ok=True)
+os.makedirs(app.config['EVENT_LOG_DIR'], exist_ok=True)
 
 db = SQLAlchemy(app)
 
@@ -30,23 +214,38 @@ class User(db.Model):
     password_hash = db.Column(db.String(200))
     is_admin = db.Column(db.Boolean, default=False)
     is_banned = db.Column(db.Boolean, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    banned_at = db.Column(db.DateTime, index=True)
 
 class Video(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200))
-    filename = db.Column(db.String(255))
+    # Индекс для sweep-uploads: он ищет видео по пачкам ключей хранилища
+    filename = db.Column(db.String(255), index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     views = db.Column(db.Integer, default=0)
     is_blocked = db.Column(db.Boolean, default=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    # Размер файла, уровень хранения ('hot' или 'archive') и недавние просмотры,
+    # которые раз в сутки делятся пополам
+    size_bytes = db.Column(db.BigInteger)
+    storage_tier = db.Column(db.String(10), default='hot', server_default='hot')
+    recent_views = db.Column(db.Integer, default=0, server_default='0')
+    # Незаблокированные комментарии; сверяется командой reconcile-comment-counts
+    comment_count = db.Column(db.Integer, default=0, server_default='0')
+    # Оценка уникальных зрителей из скетча 'all', обновляется при сбросе скетчей
+    unique_viewers = db.Column(db.Integer, default=0, server_default='0')
     author = db.relationship('User', backref='videos')
+    # Видео автора по убыванию id: страница канала и квоты
+    __table_args__ = (db.Index('ix_video_user_id_id', 'user_id', 'id'),)
 
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    video_id = db.Column(db.Integer, db.ForeignKey('video.id'))
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id'), index=True)
     is_blocked = db.Column(db.Boolean, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     author = db.relationship('User', backref='comments')
     video = db.relationship('Video', backref='comments')
 
@@ -56,17 +255,127 @@ class Like(db.Model):
     video_id = db.Column(db.Integer, db.ForeignKey('video.id'))
     is_like = db.Column(db.Boolean, default=True)
 
-# Создаем базу и админа
-with app.app_context():
+# Счётчики канала: видимые (незаблокированные) видео и их просмотры.
+# Меняются приращениями там же, где меняются видео, строка создаётся при первом обращении
+class UserStats(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    video_count = db.Column(db.Integer, default=0)
+    total_views = db.Column(db.BigInteger, default=0)
+
+# Регистры HyperLogLog зрителей видео за день ('YYYY-MM-DD') или за всё время ('all')
+class ViewerSketch(db.Model):
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id'), primary_key=True)
+    day = db.Column(db.String(10), primary_key=True)
+    registers = db.Column(db.LargeBinary)
+
+# Дневные сводки журнала событий по видео и по пользователям (зрителям)
+class VideoDailyEvents(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    video_id = db.Column(db.Integer, primary_key=True)
+    views = db.Column(db.Integer, default=0)
+    plays = db.Column(db.Integer, default=0)
+    seeks = db.Column(db.Integer, default=0)
+    likes = db.Column(db.Integer, default=0)
+
+class UserDailyEvents(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    user_id = db.Column(db.Integer, primary_key=True)
+    views = db.Column(db.Integer, default=0)
+    plays = db.Column(db.Integer, default=0)
+    seeks = db.Column(db.Integer, default=0)
+    likes = db.Column(db.Integer, default=0)
+
+# Просмотренные секунды и число сессий просмотра по дням (из heartbeat плеера)
+class VideoWatchTime(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    video_id = db.Column(db.Integer, primary_key=True)
+    seconds = db.Column(db.Float, default=0)
+    sessions = db.Column(db.Integer, default=0)
+
+# Сводка по дням для панели администратора (команда rollup)
+class DailyRollup(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    uploads = db.Column(db.Integer, default=0)
+    comments = db.Column(db.Integer, default=0)
+    registrations = db.Column(db.Integer, default=0)
+    bans = db.Column(db.Integer, default=0)
+    views = db.Column(db.Integer, default=0)
+    watch_seconds = db.Column(db.Float, default=0)
+
+# Самые просматриваемые видео за TOP_VIDEOS_DAYS, пересчитываются вместе со сводкой
+class TopVideo(db.Model):
+    rank = db.Column(db.Integer, primary_key=True)
+    video_id = db.Column(db.Integer)
+    title = db.Column(db.String(200))
+    views = db.Column(db.Integer)
+
+# Запуски проверки хранилища: сколько просмотрено, сколько лишних файлов и сколько места освобождено
+class SweepRun(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    deleted = db.Column(db.Boolean, default=False)
+    scanned = db.Column(db.Integer, default=0)
+    orphans = db.Column(db.Integer, default=0)
+    orphan_bytes = db.Column(db.BigInteger, default=0)
+    reclaimed_bytes = db.Column(db.BigInteger, default=0)
+    missing = db.Column(db.Integer, default=0)
+
+# Уже учтённые сегменты журнала: каждый сегмент прибавляется к сводкам ровно один раз
+class EventSegment(db.Model):
+    name = db.Column(db.String(100), primary_key=True)
+    events = db.Column(db.Integer)
+    processed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Версии ресурсов для ETag/Last-Modified: 'index', 'video:<id>', 'user:<id>'
+class VersionStamp(db.Model):
+    key = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+def ensure_schema():
+    # Миграций нет, а create_all не меняет существующие таблицы:
+    # недостающие колонки и индексы добавляем сами. Возвращает добавленные (таблица, колонка)
+    inspector = db.inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    added = set()
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+                    conn.execute(text(f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {ddl}'))
+                    added.add((table.name, column.name))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+    return added
+
+# Создаем базу и админа. Можно запускать повторно и из нескольких процессов:
+# таблицы и колонки создаются только недостающие, админ вставляется без конфликта
+def init_db():
     db.create_all()
-    if not User.query.filter_by(username='admin').first():
-        admin = User(
-            username='admin',
-            password_hash=generate_password_hash('admin'),
-            is_admin=True
-        )
-        db.session.add(admin)
-        db.session.commit()
+    added = ensure_schema()
+    if ('video', 'comment_count') in added:
+        # Колонка появилась со значением 0 у всех видео - досчитываем по комментариям
+        reconcile_comment_counts()
+    db.session.execute(dialect_insert(User).values(
+        username='admin', password_hash=generate_password_hash('admin'), is_admin=True, is_banned=False,
+        created_at=datetime.utcnow()).on_conflict_do_nothing(index_elements=['username']))
+    db.session.commit()
+
+_db_initialized = False
+_init_lock = threading.Lock()
+
+@app.before_request
+def auto_init_db():
+    global _db_initialized
+    if _db_initialized or not app.config['AUTO_INIT_DB']:
+        return
+    with _init_lock:
+        if not _db_initialized:
+            init_db()
+            _db_initialized = True
 
 # Хелперы
 def current_user():
@@ -78,510 +387,1298 @@ def is_admin():
     user = current_user()
     return user and user.is_admin
 
+def user_stats(user_id):
+    stats = db.session.get(UserStats, user_id)
+    if stats:
+        return stats
+    # Пересчёт один раз на пользователя; конкурентную вставку другого воркера просто перечитываем
+    video_count, total_views = db.session.query(db.func.count(Video.id), db.func.coalesce(db.func.sum(Video.views), 0)) \
+        .filter(Video.user_id == user_id, Video.is_blocked == False).one()
+    try:
+        with db.session.begin_nested():
+            stats = UserStats(user_id=user_id, video_count=video_count, total_views=total_views)
+            db.session.add(stats)
+    except IntegrityError:
+        stats = db.session.get(UserStats, user_id)
+    return stats
+
+def adjust_stats(user_id, videos=0, views=0):
+    # Вызывать до commit, в той же транзакции, что и изменение видео
+    updated = db.session.execute(update(UserStats).where(UserStats.user_id == user_id).values(
+        video_count=UserStats.video_count + videos, total_views=UserStats.total_views + views)).rowcount
+    if not updated:
+        # Строки ещё нет: пересчёт уже учтёт изменение, которое сейчас в сессии
+        db.session.flush()
+        user_stats(user_id)
+
+def change_comment_count(video_id, delta):
+    # Приращение в самом UPDATE: параллельные комментарии не теряют друг друга
+    db.session.execute(update(Video).where(Video.id == video_id)
+                       .values(comment_count=Video.comment_count + delta))
+
+def change_comment_counts(deltas):
+    # То же для многих видео сразу ({id видео: приращение}), один executemany
+    table = Video.__table__
+    if deltas:
+        db.session.execute(update(table).where(table.c.id == bindparam('video_id'))
+                           .values(comment_count=table.c.comment_count + bindparam('delta')),
+                           [{'video_id': video_id, 'delta': delta} for video_id, delta in deltas.items()])
+
+def reconcile_comment_counts(batch=1000, log=lambda msg: None):
+    visible = select(db.func.count(Comment.id)).where(Comment.video_id == Video.id, Comment.is_blocked == False) \
+        .correlate(Video).scalar_subquery()
+    last_id, fixed = 0, 0
+    while True:
+        upper = db.session.execute(select(Video.id).where(Video.id > last_id).order_by(Video.id)
+                                   .offset(batch - 1).limit(1)).scalar()
+        # Диапазон id на пачку; переписываем только расходящиеся строки
+        criteria = [Video.id > last_id] + ([Video.id <= upper] if upper else [])
+        fixed += db.session.execute(update(Video).where(*criteria, Video.comment_count != visible)
+                                    .values(comment_count=visible)).rowcount
+        db.session.commit()
+        if not upper:
+            break
+        last_id = upper
+        log(f'Проверено до id {last_id}, исправлено: {fixed}')
+    return fixed
+
+def dialect_insert(model):
+    # INSERT с ON CONFLICT есть только в диалектных вариантах
+    return {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}[db.engine.dialect.name](model)
+
+def upsert_add(model, rows, batch=1000):
+    # Прибавить счётчики к существующим строкам или вставить новые, один запрос на пачку
+    table = model.__table__
+    keys = [column.name for column in table.primary_key]
+    statement = dialect_insert(table)
+    statement = statement.on_conflict_do_update(index_elements=keys, set_={
+        name: table.c[name] + statement.excluded[name] for name in table.c.keys() if name not in keys})
+    for i in range(0, len(rows), batch):
+        db.session.execute(statement, rows[i:i + batch])
+
+# Кэширование
+def bump_stamps(*keys):
+    # Вызывать до commit, чтобы новая версия попала в ту же транзакцию.
+    # Один upsert на все ключи: массовая модерация задевает сотни страниц
+    now = datetime.utcnow()
+    keys = list(dict.fromkeys(keys))
+    if keys:
+        db.session.execute(dialect_insert(VersionStamp).values([{'key': key, 'version': 1, 'updated_at': now} for key in keys])
+                           .on_conflict_do_update(index_elements=['key'],
+                                                  set_={'version': VersionStamp.version + 1, 'updated_at': now}))
+
+def page_stamp(keys, user):
+    # Просмотры в ETag не входят: иначе каждая перезагрузка меняла бы версию
+    stamps = VersionStamp.query.filter(VersionStamp.key.in_(keys)).all()
+    versions = {s.key: s.version for s in stamps}
+    parts = [f'{key}={versions.get(key, 0)}' for key in keys]
+    # Страница ссылается на css по хэшу, после деплоя старая копия недействительна
+    parts.append(','.join(sorted(asset_files)))
+    if user:
+        parts.append(f'user={user.id},{user.is_admin:d},{user.is_banned:d}')
+    etag = hashlib.sha1(';'.join(parts).encode()).hexdigest()[:20]
+    last_modified = max((s.updated_at for s in stamps), default=None)
+    return etag, last_modified
+
+def is_not_modified(etag, last_modified):
+    if request.if_none_match:
+        hit = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since and last_modified:
+        hit = last_modified.replace(microsecond=0, tzinfo=timezone.utc) <= request.if_modified_since
+    else:
+        hit = False
+    inc_metric('pixtube_cache_requests_total', (('cache', 'page'), ('result', 'hit' if hit else 'miss')))
+    return hit
+
+def stamped(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    return response
+
+@app.after_request
+def apply_cache_policy(response):
+    endpoint = request.endpoint
+    if endpoint == 'static' and request.view_args['filename'].startswith('videos/'):
+        response.headers['Cache-Control'] = f"public, max-age={app.config['MEDIA_CACHE_SECONDS']}, immutable"
+    elif endpoint in ('index', 'video', 'channel') and response.status_code in (200, 304):
+        if 'user_id' in session:
+            response.headers['Cache-Control'] = 'private, no-cache'
+        else:
+            response.headers['Cache-Control'] = f"public, max-age={app.config['PAGE_CACHE_SECONDS']}"
+        response.vary.add('Cookie')
+    elif endpoint == 'media' and response.status_code in (200, 206, 304):
+        # Только кэш браузера и ненадолго: заблокированное видео не должно играть из кэша
+        if request.view_args.get('tag'):
+            response.headers['Cache-Control'] = f"private, max-age={app.config['MEDIA_PRIVATE_CACHE_SECONDS']}, immutable"
+        else:
+            response.headers['Cache-Control'] = 'private, no-cache'
+    elif endpoint == 'media' and response.status_code == 302:
+        response.headers['Cache-Control'] = f"private, max-age={app.config['S3_URL_TTL'] // 2}"
+    elif endpoint == 'asset' and response.status_code == 200:
+        response.headers['Cache-Control'] = f"public, max-age={app.config['MEDIA_CACHE_SECONDS']}, immutable"
+    elif endpoint == 'asset':
+        # 404 на чужой отпечаток (новая страница попала на старый воркер во время выкладки) не кэшируем
+        response.headers['Cache-Control'] = 'no-store'
+    elif endpoint in ('admin', 'admin_dashboard'):
+        response.headers['Cache-Control'] = 'private, no-store'
+    return response
+
+# Сжатие ответов (gzip, brotli если установлен)
+COMPRESSIBLE_TYPES = {'text/html', 'text/css', 'text/plain', 'application/json', 'application/javascript', 'image/svg+xml'}
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def compress(data, encoding, static=False):
+    # Статика сжимается один раз, поэтому для неё максимальный уровень
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if static else 5)
+    return gzip.compress(data, compresslevel=9 if static else app.config['COMPRESS_LEVEL'])
+
+def compress_stream(chunks, encoding):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=5)
+        for chunk in chunks:
+            out = compressor.process(chunk)
+            if out:
+                yield out
+        yield compressor.finish()
+    else:
+        compressor = zlib.compressobj(app.config['COMPRESS_LEVEL'], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            out = compressor.compress(chunk)
+            if out:
+                yield out
+        yield compressor.flush()
+
+def accepted_encoding():
+    if brotli and request.accept_encodings['br']:
+        return 'br'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+@app.after_request
+def compress_response(response):
+    # direct_passthrough - это файлы из send_file (видео), их не сжимаем
+    if (request.method == 'HEAD' or response.status_code < 200 or response.status_code in (204, 304)
+            or response.direct_passthrough or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = accepted_encoding()
+    if not encoding:
+        return response
+
+    # Готовый вариант есть только у существующих css; страница 404 сжимается как обычно
+    variant_key = (request.view_args['name'], encoding) if request.endpoint == 'asset' else None
+    if response.status_code == 200 and variant_key in asset_variants:
+        response.set_data(asset_variants[variant_key])
+    elif response.is_streamed:
+        response.response = compress_stream(response.iter_encoded(), encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        if len(data) >= app.config['COMPRESS_STREAM_SIZE']:
+            chunks = (data[i:i + STREAM_CHUNK_SIZE] for i in range(0, len(data), STREAM_CHUNK_SIZE))
+            response.response = compress_stream(chunks, encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            response.set_data(compress(data, encoding))
+
+    response.headers['Content-Encoding'] = encoding
+    # Сжатое тело отличается побайтно, поэтому ETag становится слабым
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+# Статические ресурсы: css и шрифты из static/assets отдаются под именами
+# с хэшем содержимого, поэтому их можно кэшировать навсегда
+ASSETS_FOLDER = os.path.join(app.root_path, 'static', 'assets')
+ASSET_TYPES = {'.css': 'text/css; charset=utf-8', '.woff2': 'font/woff2'}
+assets = {}          # 'index.css' -> 'index.0123456789.css'
+asset_files = {}     # 'index.0123456789.css' -> (содержимое, mimetype)
+asset_variants = {}  # ('index.0123456789.css', 'gzip') -> сжатое содержимое
+
+# Иконки Font Awesome Free 6.4.0, которые используются в шаблонах.
+# После добавления новой иконки: flask --app app build-icons <папка webfonts из дистрибутива FA>
+ICONS = {
+    'solid': {
+        'arrow-left': 'f060', 'ban': 'f05e', 'check-circle': 'f058', 'cloud-upload-alt': 'f0ee',
+        'comment-slash': 'f4b3', 'comments': 'f086', 'crown': 'f521', 'eye': 'f06e', 'file-video': 'f1c8', 'lock': 'f023',
+        'play-circle': 'f144', 'unlock': 'f09c', 'user': 'f007', 'user-check': 'f4fc',
+        'user-slash': 'f506', 'users': 'f0c0', 'video': 'f03d',
+    },
+    'regular': {'calendar': 'f133', 'clock': 'f017', 'comment-dots': 'f4ad'},
+    'brands': {'youtube': 'f167'},
+}
+ICON_FONTS = {
+    'solid': ('fa-solid-900.ttf', 'Pixtube Icons', 900),
+    'regular': ('fa-regular-400.ttf', 'Pixtube Icons', 400),
+    'brands': ('fa-brands-400.ttf', 'Pixtube Brands', 400),
+}
+
+def load_assets():
+    assets.clear()
+    asset_files.clear()
+    asset_variants.clear()
+    # Сначала шрифты, чтобы css уже мог сослаться на их версии с хэшем
+    names = sorted(os.listdir(ASSETS_FOLDER), key=lambda name: name.endswith('.css'))
+    for name in names:
+        stem, ext = os.path.splitext(name)
+        if ext not in ASSET_TYPES:
+            continue
+        with open(os.path.join(ASSETS_FOLDER, name), 'rb') as f:
+            data = f.read()
+        if ext == '.css':
+            data = re.sub(rb'url\(([\w.-]+)\)',
+                          lambda m: b'url(%s)' % assets.get(m[1].decode(), m[1].decode()).encode(), data)
+        hashed = f'{stem}.{hashlib.sha256(data).hexdigest()[:10]}{ext}'
+        assets[name] = hashed
+        asset_files[hashed] = (data, ASSET_TYPES[ext])
+        if ext == '.css':
+            asset_variants[hashed, 'gzip'] = compress(data, 'gzip', static=True)
+            if brotli:
+                asset_variants[hashed, 'br'] = compress(data, 'br', static=True)
+
+load_assets()
+
+@app.context_processor
+def asset_helpers():
+    return {'asset_url': lambda name: f'/assets/{assets[name]}'}
+
+@app.route('/assets/<name>')
+def asset(name):
+    if name not in asset_files:
+        abort(404)
+    data, mimetype = asset_files[name]
+    return Response(data, mimetype=mimetype)
+
+# Общее состояние воркеров
+SHARED_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metric (name TEXT, labels TEXT, value REAL, PRIMARY KEY (name, labels));
+CREATE TABLE IF NOT EXISTS rate_bucket (key TEXT PRIMARY KEY, tokens REAL, updated REAL);
+CREATE TABLE IF NOT EXISTS lease (name TEXT PRIMARY KEY, expires REAL);
+CREATE TABLE IF NOT EXISTS comment_feed (seq INTEGER PRIMARY KEY AUTOINCREMENT, video_id INTEGER, data TEXT, created REAL);
+"""
+_shared = threading.local()
+
+def shared_db():
+    # Соединение на поток; после fork открываем заново
+    if getattr(_shared, 'pid', None) != os.getpid():
+        conn = sqlite3.connect(app.config['SHARED_STATE_DB'], timeout=5, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(SHARED_SCHEMA)
+        _shared.conn, _shared.pid = conn, os.getpid()
+    return _shared.conn
+
+def take_lease(name, seconds):
+    # Работа, которую достаточно делать одному воркеру: её выполняет тот,
+    # кто первым занял аренду; следующий сможет занять её через seconds
+    now = time.time()
+    cursor = shared_db().execute('INSERT INTO lease VALUES (?, ?) ON CONFLICT (name) DO UPDATE '
+                                 'SET expires = excluded.expires WHERE expires < ?', (name, now + seconds, now))
+    return cursor.rowcount == 1
+
+def run_in_background(func, *args):
+    # Долгая работа (копирование файлов) не должна задерживать ответ
+    def target():
+        with app.app_context():
+            try:
+                func(*args)
+            except Exception:
+                app.logger.exception('Фоновая задача %s упала', func.__name__)
+    threading.Thread(target=target, daemon=True).start()
+
+# Периодические задачи воркера: запускаются после запроса, когда подошёл срок
+periodic_tasks = []  # [функция, ключ конфига с интервалом, время следующего запуска]
+_periodic_lock = threading.Lock()
+
+def periodic(interval_key):
+    def decorator(func):
+        periodic_tasks.append([func, interval_key, 0])
+        return func
+    return decorator
+
+@app.teardown_request
+def run_periodic_tasks(exc):
+    if not _periodic_lock.acquire(blocking=False):
+        return
+    try:
+        now = time.monotonic()
+        for task in periodic_tasks:
+            if now >= task[2]:
+                task[2] = now + app.config[task[1]]
+                try:
+                    task[0]()
+                except Exception:
+                    app.logger.exception('Периодическая задача %s упала', task[0].__name__)
+    finally:
+        _periodic_lock.release()
+
+@atexit.register
+def run_periodic_tasks_on_exit():
+    with app.app_context():
+        for func, _, _ in periodic_tasks:
+            try:
+                func()
+            except Exception:
+                app.logger.exception('Периодическая задача %s упала', func.__name__)
+
+# Метрики в формате Prometheus
+METRICS = {
+    'pixtube_request_duration_seconds': ('histogram', 'Время обработки запроса по endpoint'),
+    'pixtube_responses_total': ('counter', 'Ответы по endpoint и коду статуса'),
+    'pixtube_upload_folder_bytes_total': ('counter', 'Байт отдано из UPLOAD_FOLDER'),
+    'pixtube_upload_size_bytes': ('histogram', 'Размер загруженных видео'),
+    'pixtube_upload_duration_seconds': ('histogram', 'Время приёма и сохранения загрузки'),
+    'pixtube_db_queries_total': ('counter', 'Число SQL-запросов'),
+    'pixtube_db_query_seconds_total': ('counter', 'Суммарное время SQL-запросов'),
+    'pixtube_video_views_total': ('counter', 'Засчитанные просмотры видео'),
+    'pixtube_cache_requests_total': ('counter', 'Обращения к кэшам по результату (hit/miss)'),
+    'pixtube_rate_limited_total': ('counter', 'Запросы, отклонённые ограничением частоты'),
+    'pixtube_uploads_rejected_total': ('counter', 'Отклонённые загрузки по причине'),
+    'pixtube_worker_boot_seconds': ('histogram', 'Время от fork до готовности воркера'),
+    'pixtube_sse_polls_total': ('counter', 'SSE-соединения без свободного потока (опрос вместо потока)'),
+    'pixtube_first_request_duration_seconds': ('histogram', 'Длительность первого запроса воркера'),
+}
+METRIC_BUCKETS = {
+    'pixtube_request_duration_seconds': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    'pixtube_upload_size_bytes': tuple(mb * 1024 * 1024 for mb in (1, 10, 50, 100, 250, 500, 1024)),
+    'pixtube_upload_duration_seconds': (0.1, 0.5, 1, 5, 15, 30, 60, 120, 300),
+    'pixtube_worker_boot_seconds': (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    'pixtube_first_request_duration_seconds': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+}
+_metric_deltas = {}  # (имя, метки) -> прирост с последнего сброса
+_metric_lock = threading.Lock()
+
+def format_labels(labels):
+    return ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+
+def inc_metric(name, labels=(), value=1):
+    key = (name, format_labels(labels))
+    with _metric_lock:
+        _metric_deltas[key] = _metric_deltas.get(key, 0) + value
+
+def observe_metric(name, value, labels=()):
+    labels = tuple(labels)
+    # Нулевые приращения тоже пишем, чтобы у серии всегда был полный набор корзин
+    for le in METRIC_BUCKETS[name]:
+        inc_metric(name + '_bucket', labels + (('le', le),), int(value <= le))
+    inc_metric(name + '_bucket', labels + (('le', '+Inf'),))
+    inc_metric(name + '_sum', labels, value)
+    inc_metric(name + '_count', labels)
+
+@periodic('METRICS_FLUSH_SECONDS')
+def flush_metrics():
+    global _metric_deltas
+    with _metric_lock:
+        deltas, _metric_deltas = _metric_deltas, {}
+    if not deltas:
+        return
+    conn = shared_db()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany('INSERT INTO metric VALUES (?, ?, ?) '
+                         'ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value',
+                         [(name, labels, value) for (name, labels), value in deltas.items()])
+        conn.execute('COMMIT')
+    except sqlite3.Error:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        # Не теряем приращения: вернём их и попробуем в следующий раз
+        with _metric_lock:
+            for key, value in deltas.items():
+                _metric_deltas[key] = _metric_deltas.get(key, 0) + value
+        raise
+
+def metric_sort_key(row):
+    match = re.search(r'le="([^"]+)"', row[1])
+    return (re.sub(r',?le="[^"]+"', '', row[1]), float(match[1]) if match else 0)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+def worker_started():
+    # Хуки gunicorn.conf.py: post_fork и post_worker_init
+    _boot.update(started=time.perf_counter(), served=False)
+
+def worker_ready():
+    observe_metric('pixtube_worker_boot_seconds', time.perf_counter() - _boot['started'])
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or 'none'
+    duration = time.perf_counter() - g.request_started
+    observe_metric('pixtube_request_duration_seconds', duration, (('endpoint', endpoint), ('method', request.method)))
+    if not _boot['served']:
+        # Холодный запрос: первое соединение с базой, ленивая инициализация
+        _boot['served'] = True
+        observe_metric('pixtube_first_request_duration_seconds', duration)
+    inc_metric('pixtube_responses_total', (('endpoint', endpoint), ('status', response.status_code)))
+    if (endpoint == 'static' and request.view_args['filename'].startswith('videos/')
+            or endpoint == 'media' and response.status_code in (200, 206)):
+        inc_metric('pixtube_upload_folder_bytes_total', value=g.get('media_bytes', response.content_length or 0))
+    return response
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_query_metrics(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    if getattr(_explaining, 'active', False):
+        return
+    inc_metric('pixtube_db_queries_total')
+    inc_metric('pixtube_db_query_seconds_total', value=elapsed)
+    if has_request_context():
+        g.db_queries = g.get('db_queries', 0) + 1
+        g.db_time = g.get('db_time', 0) + elapsed
+        if g.get('render_started'):
+            g.db_time_in_render = g.get('db_time_in_render', 0) + elapsed
+    if elapsed * 1000 >= app.config['SLOW_QUERY_MS']:
+        log_slow_query(conn, statement, parameters, elapsed, executemany)
+
+@event.listens_for(Engine, 'handle_error')
+def drop_query_timer(exception_context):
+    started = exception_context.connection and exception_context.connection.info.get('query_started')
+    if started:
+        started.pop()
+
+# Профилирование SQL
+_explaining = threading.local()
+
+def log_slow_query(conn, statement, parameters, elapsed, executemany):
+    plan = ''
+    if not executemany and statement.lstrip().upper().startswith('SELECT'):
+        prefix = 'EXPLAIN QUERY PLAN ' if conn.dialect.name == 'sqlite' else 'EXPLAIN '
+        # План снимаем отдельным соединением, чтобы не мешать транзакции запроса
+        _explaining.active = True
+        try:
+            with conn.engine.connect() as explain_conn:
+                rows = explain_conn.exec_driver_sql(prefix + statement, parameters).fetchall()
+            plan = '\n'.join(' '.join(str(col) for col in row) for row in rows)
+        except Exception as e:
+            plan = f'EXPLAIN не удался: {e}'
+        finally:
+            _explaining.active = False
+    endpoint = request.endpoint if has_request_context() else None
+    app.logger.warning('Медленный запрос %.1f мс (%s): %s %r\n%s',
+                       elapsed * 1000, endpoint, statement, parameters, plan)
+
+@before_render_template.connect_via(app)
+def start_render_timer(sender, template, context, **extra):
+    g.render_started = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def stop_render_timer(sender, template, context, **extra):
+    g.render_time = g.get('render_time', 0) + time.perf_counter() - g.pop('render_started')
+
+@app.after_request
+def add_server_timing(response):
+    if not (app.debug or app.config['SERVER_TIMING']):
+        return response
+    total = time.perf_counter() - g.request_started
+    db_time = g.get('db_time', 0)
+    # Ленивые загрузки из шаблона учитываются как время БД, а не рендера
+    render = g.get('render_time', 0) - g.get('db_time_in_render', 0)
+    other = max(total - db_time - render, 0)
+    response.headers['Server-Timing'] = (f'db;desc="{g.get("db_queries", 0)} queries";dur={db_time * 1000:.1f}, '
+                                         f'render;dur={render * 1000:.1f}, other;dur={other * 1000:.1f}, '
+                                         f'total;dur={total * 1000:.1f}')
+    response.headers['X-DB-Queries'] = str(g.get('db_queries', 0))
+    return response
+
+@app.route('/metrics')
+def metrics():
+    token = app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        abort(403)
+    flush_metrics()
+    samples = {}
+    for name, labels, value in shared_db().execute('SELECT name, labels, value FROM metric'):
+        samples.setdefault(name, []).append((name, labels, value))
+
+    lines = []
+    for family, (kind, help_text) in METRICS.items():
+        lines.append(f'# HELP {family} {help_text}')
+        lines.append(f'# TYPE {family} {kind}')
+        names = [family + suffix for suffix in ('_bucket', '_sum', '_count')] if kind == 'histogram' else [family]
+        for name in names:
+            for _, labels, value in sorted(samples.get(name, []), key=metric_sort_key):
+                value = int(value) if value == int(value) else value
+                lines.append(f'{name}{{{labels}}} {value}' if labels else f'{name} {value}')
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+# Ограничение частоты запросов
+def take_token(key, burst, per_minute):
+    # Возвращает (разрешено, через сколько секунд появится токен)
+    conn = shared_db()
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        row = conn.execute('SELECT tokens, updated FROM rate_bucket WHERE key = ?', (key,)).fetchone()
+        tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * per_minute / 60)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        conn.execute('INSERT OR REPLACE INTO rate_bucket VALUES (?, ?, ?)', (key, tokens, now))
+        conn.execute('COMMIT')
+    except sqlite3.Error:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    return allowed, math.ceil((1 - tokens) * 60 / per_minute)
+
+@app.before_request
+def rate_limit():
+    limit = app.config['RATE_LIMITS'].get(request.endpoint)
+    if request.method != 'POST' or not limit or not app.config['RATE_LIMIT_ENABLED']:
+        return None
+    who = f"u{session['user_id']}" if 'user_id' in session else f'ip{request.remote_addr}'
+    try:
+        allowed, retry_after = take_token(f'{request.endpoint}:{who}', *limit)
+    except sqlite3.Error:
+        # Недоступное общее хранилище не должно ронять сайт
+        app.logger.exception('Ограничение частоты недоступно')
+        return None
+    if allowed:
+        return None
+    inc_metric('pixtube_rate_limited_total', (('endpoint', request.endpoint),))
+    response = Response('Слишком много запросов, попробуйте позже', status=429, mimetype='text/plain')
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+@periodic('RATE_LIMIT_PRUNE_SECONDS')
+def prune_rate_buckets():
+    # За час любая корзина снова полна, такие строки не нужны
+    shared_db().execute('DELETE FROM rate_bucket WHERE updated < ?', (time.time() - 3600,))
+
+# Просмотры каналов
+_author_views = {}  # id автора -> просмотры с последнего сброса
+_author_views_lock = threading.Lock()
+
+def record_author_view(user_id):
+    with _author_views_lock:
+        _author_views[user_id] = _author_views.get(user_id, 0) + 1
+
+@periodic('VIEWS_FLUSH_SECONDS')
+def flush_author_views():
+    global _author_views
+    with _author_views_lock:
+        pending, _author_views = _author_views, {}
+    if not pending:
+        return
+    db.session.rollback()
+    try:
+        # У забаненных статистика обнулена вместе с удалёнными видео
+        active = set(db.session.execute(select(User.id).where(User.id.in_(list(pending)),
+                                                              User.is_banned == False)).scalars())
+        for user_id in sorted(active):
+            adjust_stats(user_id, views=pending[user_id])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        with _author_views_lock:
+            for user_id, views in pending.items():
+                _author_views[user_id] = _author_views.get(user_id, 0) + views
+        raise
+
+# Уникальные зрители
+class HyperLogLog:
+    # 2^10 регистров по байту: скетч 1 КБ, стандартная ошибка 1.04/sqrt(1024) ≈ 3.25%
+    P = 10
+    M = 1 << P
+    ALPHA = 0.7213 / (1 + 1.079 / M)
+
+    def __init__(self, registers=None):
+        self.registers = bytearray(registers or self.M)
+
+    def add(self, item):
+        x = int.from_bytes(hashlib.blake2b(item.encode(), digest_size=8).digest(), 'big')
+        rest = x & ((1 << (64 - self.P)) - 1)
+        rank = 64 - self.P - rest.bit_length() + 1
+        index = x >> (64 - self.P)
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        # Объединение множеств - максимум по регистрам, поэтому скетчи воркеров и дней складываются
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        estimate = self.ALPHA * self.M * self.M / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.M and zeros:
+            # На малых числах точнее линейный подсчёт по пустым регистрам
+            return round(self.M * math.log(self.M / zeros))
+        return round(estimate)
+
+_viewer_sketches = {}  # (video_id, день) -> скетч с последнего сброса
+_viewer_lock = threading.Lock()
+
+def record_viewer(video_id, viewer):
+    day = datetime.utcnow().strftime('%Y-%m-%d')
+    with _viewer_lock:
+        for key in ((video_id, day), (video_id, 'all')):
+            _viewer_sketches.setdefault(key, HyperLogLog()).add(viewer)
+
+@periodic('VIEWERS_FLUSH_SECONDS')
+def flush_viewer_sketches():
+    global _viewer_sketches
+    with _viewer_lock:
+        pending, _viewer_sketches = _viewer_sketches, {}
+    if not pending:
+        return
+    # Незавершённые изменения запроса, после которого идёт сброс, сюда не попадают
+    db.session.rollback()
+    try:
+        # Видео могли удалить (бан автора), пока скетч копился
+        alive = set(db.session.execute(select(Video.id).where(Video.id.in_({video_id for video_id, _ in pending}))).scalars())
+        pending = {key: sketch for key, sketch in pending.items() if key[0] in alive}
+        rows = ViewerSketch.query.filter(db.tuple_(ViewerSketch.video_id, ViewerSketch.day).in_(list(pending))) \
+            .with_for_update().all()
+        existing = {(row.video_id, row.day): row for row in rows}
+        estimates = {}
+        for (video_id, day), sketch in pending.items():
+            row = existing.get((video_id, day))
+            merged = HyperLogLog(row.registers if row else None)
+            merged.merge(sketch)
+            if row:
+                row.registers = bytes(merged.registers)
+            else:
+                db.session.add(ViewerSketch(video_id=video_id, day=day, registers=bytes(merged.registers)))
+            if day == 'all':
+                estimates[video_id] = merged.count()
+        if estimates:
+            db.session.execute(update(Video), [{'id': video_id, 'unique_viewers': n} for video_id, n in estimates.items()])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        # Скетчи сливаются без потерь, вернём их к новым и попробуем в следующий раз
+        with _viewer_lock:
+            for key, sketch in pending.items():
+                _viewer_sketches.setdefault(key, HyperLogLog()).merge(sketch)
+        raise
+
+@periodic('VIEWERS_PRUNE_SECONDS')
+def prune_viewer_sketches():
+    if take_lease('prune-viewer-sketches', 24 * 3600):
+        cutoff = (datetime.utcnow() - timedelta(days=app.config['VIEWER_SKETCH_DAYS'])).strftime('%Y-%m-%d')
+        ViewerSketch.query.filter(ViewerSketch.day != 'all', ViewerSketch.day < cutoff).delete()
+        db.session.commit()
+
+# Журнал событий: строка 'время<TAB>тип<TAB>видео<TAB>пользователь<TAB>значение',
+# пользователь пуст для гостя, значение - позиция в секундах для play/seek
+EVENT_KINDS = ('view', 'play', 'seek', 'like')
+
+def valid_id(value):
+    # id от клиента: целое в пределах INTEGER базы, иначе строка сломает запись сводок
+    return type(value) is int and 0 < value < 2 ** 31
+
+_events = []
+_event_lock = threading.Lock()
+_event_segment = {'pid': None, 'file': None, 'opened': 0}
+
+def log_event(kind, video_id, value=''):
+    line = f"{int(time.time())}\t{kind}\t{video_id}\t{session.get('user_id', '')}\t{value}\n"
+    with _event_lock:
+        _events.append(line)
+        full = len(_events) >= app.config['EVENT_BUFFER_LINES']
+    if full:
+        flush_events()
+
+def close_event_segment():
+    # Закрытый сегмент (.log) больше не меняется, его можно обрабатывать
+    segment = _event_segment
+    if segment['file'] and segment['pid'] == os.getpid():
+        segment['file'].close()
+        os.replace(segment['file'].name, segment['file'].name[:-len('.open')] + '.log')
+    segment['file'] = None
+
+@periodic('EVENT_FLUSH_SECONDS')
+def flush_events():
+    global _events
+    with _event_lock:
+        lines, _events = _events, []
+        segment = _event_segment
+        if segment['pid'] != os.getpid():
+            # После fork сегмент родителя не наш
+            segment.update(pid=os.getpid(), file=None)
+        if lines:
+            if not segment['file']:
+                name = f'{datetime.utcnow():%Y%m%d-%H%M%S}-{os.getpid()}.open'
+                segment['file'] = open(os.path.join(app.config['EVENT_LOG_DIR'], name), 'a', encoding='utf-8')
+                segment['opened'] = time.time()
+            segment['file'].write(''.join(lines))
+            segment['file'].flush()
+        if segment['file'] and (segment['file'].tell() >= app.config['EVENT_SEGMENT_BYTES']
+                                or time.time() - segment['opened'] >= app.config['EVENT_SEGMENT_SECONDS']):
+            close_event_segment()
+
+@atexit.register
+def flush_events_on_exit():
+    flush_events()
+    with _event_lock:
+        close_event_segment()
+
+_watch_time = {}  # (video_id, день) -> [секунды, сессии] с последнего сброса
+_watch_lock = threading.Lock()
+
+def record_watch(video_id, seconds, new_session):
+    key = (video_id, datetime.utcnow().date())
+    with _watch_lock:
+        totals = _watch_time.setdefault(key, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += new_session
+
+@periodic('HEARTBEAT_FLUSH_SECONDS')
+def flush_watch_time():
+    global _watch_time
+    with _watch_lock:
+        pending, _watch_time = _watch_time, {}
+    if not pending:
+        return
+    db.session.rollback()
+    rows = [{'day': day, 'video_id': video_id, 'seconds': seconds, 'sessions': sessions}
+            for (video_id, day), (seconds, sessions) in pending.items()]
+    try:
+        upsert_add(VideoWatchTime, rows)
+        db.session.commit()
+    except (OverflowError, DataError):
+        # Строку, которую база не принимает, она не примет и потом: пишем по одной,
+        # отвергнутые отбрасываем, а не возвращаем в очередь
+        db.session.rollback()
+        for row in rows:
+            try:
+                upsert_add(VideoWatchTime, [row])
+                db.session.commit()
+            except (OverflowError, DataError):
+                db.session.rollback()
+                app.logger.warning('Время просмотра отброшено: %s', row)
+    except Exception:
+        db.session.rollback()
+        with _watch_lock:
+            for key, (seconds, sessions) in pending.items():
+                totals = _watch_time.setdefault(key, [0.0, 0])
+                totals[0] += seconds
+                totals[1] += sessions
+        raise
+
+def count_by_day(column, since, *criteria):
+    day = db.func.date(column)
+    rows = db.session.execute(select(day, db.func.count()).where(column >= since, *criteria).group_by(day)).all()
+    # SQLite возвращает дату строкой, PostgreSQL - датой
+    return {date.fromisoformat(str(d)): n for d, n in rows}
+
+def build_rollups(log=lambda msg: None):
+    _, touched = aggregate_events(log)
+    # Пересчитываем последние два дня сводки: сегменты журнала и время просмотра приходят с опозданием
+    # (после полуночи закрывается сегмент за вчера), а ещё раньше - если новые сегменты задели старые дни
+    start = db.session.query(db.func.max(DailyRollup.day)).scalar()
+    if start is not None:
+        start = min([start, datetime.utcnow().date() - timedelta(days=1), *touched])
+    else:
+        start = db.session.query(db.func.min(Video.created_at)).scalar() or datetime.utcnow()
+        start = min(start, db.session.query(db.func.min(User.created_at)).scalar() or start).date()
+    since = datetime.combine(start, datetime.min.time())
+    uploads = count_by_day(Video.created_at, since)
+    comments = count_by_day(Comment.created_at, since)
+    registrations = count_by_day(User.created_at, since)
+    bans = count_by_day(User.banned_at, since, User.is_banned == True)
+    views = dict(db.session.execute(select(VideoDailyEvents.day, db.func.sum(VideoDailyEvents.views))
+                                    .where(VideoDailyEvents.day >= start).group_by(VideoDailyEvents.day)).all())
+    watched = dict(db.session.execute(select(VideoWatchTime.day, db.func.sum(VideoWatchTime.seconds))
+                                      .where(VideoWatchTime.day >= start).group_by(VideoWatchTime.day)).all())
+    day, today = start, datetime.utcnow().date()
+    while day <= today:
+        db.session.merge(DailyRollup(day=day, uploads=uploads.get(day, 0), comments=comments.get(day, 0),
+                                     registrations=registrations.get(day, 0), bans=bans.get(day, 0),
+                                     views=views.get(day, 0), watch_seconds=watched.get(day, 0)))
+        day += timedelta(days=1)
+
+    views = db.func.sum(VideoDailyEvents.views)
+    top = db.session.execute(select(VideoDailyEvents.video_id, Video.title, views)
+                             .join(Video, Video.id == VideoDailyEvents.video_id)
+                             .where(VideoDailyEvents.day > today - timedelta(days=app.config['TOP_VIDEOS_DAYS']),
+                                    Video.is_blocked == False)
+                             .group_by(VideoDailyEvents.video_id, Video.title).order_by(views.desc()).limit(10)).all()
+    TopVideo.query.delete()
+    db.session.add_all(TopVideo(rank=rank, video_id=video_id, title=title, views=n)
+                       for rank, (video_id, title, n) in enumerate(top, 1))
+    db.session.commit()
+    log(f'Сводка пересчитана с {start}')
+
+@periodic('ROLLUP_SECONDS')
+def schedule_rollups():
+    if take_lease('rollups', app.config['ROLLUP_SECONDS']):
+        run_in_background(build_rollups)
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def aggregate_events(log=lambda msg: None):
+    folder = app.config['EVENT_LOG_DIR']
+    # Сегменты упавших воркеров закрываем за них
+    for name in os.listdir(folder):
+        if name.endswith('.open') and not pid_alive(int(name[:-len('.open')].rsplit('-', 1)[1])):
+            os.replace(os.path.join(folder, name), os.path.join(folder, name[:-len('.open')] + '.log'))
+    done = set(db.session.execute(select(EventSegment.name)).scalars())
+    total, touched = 0, set()
+    for name in sorted(n for n in os.listdir(folder) if n.endswith('.log') and n not in done):
+        per_video, per_user, count = {}, {}, 0
+        with open(os.path.join(folder, name), encoding='utf-8') as f:
+            for line in f:
+                parts = line.rstrip('\n').split('\t')
+                # Оборванную при падении воркера строку пропускаем
+                try:
+                    day = datetime.fromtimestamp(int(parts[0]), timezone.utc).date()
+                    video_id, user_id = int(parts[2]), int(parts[3]) if parts[3] else None
+                except (ValueError, IndexError, OverflowError, OSError):
+                    continue
+                if (len(parts) != 5 or parts[1] not in EVENT_KINDS or not valid_id(video_id)
+                        or user_id is not None and not valid_id(user_id)):
+                    continue
+                column = parts[1] + 's'
+                for key, rows in (((day, video_id), per_video), ((day, user_id), per_user)):
+                    if key[1] is not None:
+                        rows.setdefault(key, dict.fromkeys(('views', 'plays', 'seeks', 'likes'), 0))[column] += 1
+                count += 1
+        # Сводки и отметка о сегменте - в одной транзакции: повторный запуск не задвоит счётчики
+        try:
+            upsert_add(VideoDailyEvents, [dict(day=day, video_id=video_id, **c) for (day, video_id), c in per_video.items()])
+            upsert_add(UserDailyEvents, [dict(day=day, user_id=user_id, **c) for (day, user_id), c in per_user.items()])
+            db.session.add(EventSegment(name=name, events=count))
+            db.session.commit()
+        except (OverflowError, DataError):
+            # Сегмент, который база не принимает, откладываем в .bad, чтобы он не останавливал следующие
+            db.session.rollback()
+            os.replace(os.path.join(folder, name), os.path.join(folder, name[:-len('.log')] + '.bad'))
+            app.logger.exception('Сегмент журнала %s отложен', name)
+            continue
+        total += count
+        touched.update(day for day, _ in per_video)
+        log(f'{name}: {count} событий')
+
+    # Учтённые сегменты храним EVENT_SEGMENT_KEEP_DAYS. Сначала файл, потом отметка:
+    # файл без отметки был бы учтён повторно
+    cutoff = datetime.utcnow() - timedelta(days=app.config['EVENT_SEGMENT_KEEP_DAYS'])
+    old = db.session.execute(select(EventSegment.name).where(EventSegment.processed_at < cutoff)).scalars().all()
+    for name in old:
+        try:
+            os.remove(os.path.join(folder, name))
+        except FileNotFoundError:
+            pass
+    if old:
+        db.session.execute(delete(EventSegment).where(EventSegment.name.in_(old)))
+        db.session.commit()
+        log(f'Удалено старых сегментов: {len(old)}')
+    # Число событий и дни, которых они коснулись
+    return total, touched
+
+# Хранилище видео
+def shard_key(name):
+    # Два уровня каталогов по хэшу имени: 'ab/cd/name', по 256 подкаталогов на уровень
+    digest = hashlib.md5(name.encode()).hexdigest()
+    return f'{digest[:2]}/{digest[2:4]}/{name}'
+
+def video_mimetype(key):
+    return mimetypes.guess_type(key)[0] or 'video/mp4'
+
+def offloaded_bytes(path):
+    # Тело ответа отправит прокси: для метрики считаем, сколько он отдаст, по размеру файла и Range
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return 0
+    span = request.range and request.range.range_for_length(size)
+    return span[1] - span[0] if span else size
+
+class LocalStorage:
+    def __init__(self, root, accel_prefix=None):
+        self.root = os.path.abspath(root)
+        self.accel_prefix = accel_prefix
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def save(self, tmp_path, key):
+        os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+        os.replace(tmp_path, self.path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.delete(key)
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def size(self, key):
+        return os.path.getsize(self.path(key))
+
+    def serve(self, key):
+        # При отдаче через прокси Range и условные запросы обрабатывает он сам
+        if app.config['MEDIA_OFFLOAD']:
+            g.media_bytes = offloaded_bytes(self.path(key))
+        if app.config['MEDIA_OFFLOAD'] == 'x-accel':
+            response = Response(mimetype=video_mimetype(key))
+            response.headers['X-Accel-Redirect'] = self.accel_prefix + quote(key)
+            return response
+        return send_file(self.path(key), mimetype=video_mimetype(key), conditional=not app.config['USE_X_SENDFILE'])
+
+class S3Storage:
+    # Видео отдаются редиректом на подписанную ссылку, байты идут мимо Flask
+    def __init__(self, bucket, endpoint_url, region, url_ttl):
+        import boto3
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region)
+        self.bucket = bucket
+        self.url_ttl = url_ttl
+
+    def save(self, tmp_path, key):
+        self.client.upload_file(tmp_path, self.bucket, key, ExtraArgs={'ContentType': video_mimetype(key)})
+        os.remove(tmp_path)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def delete_many(self, keys):
+        # DeleteObjects принимает до 1000 ключей за запрос
+        keys = list(keys)
+        for i in range(0, len(keys), 1000):
+            self.client.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': key} for key in keys[i:i + 1000]], 'Quiet': True})
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+        except self.client.exceptions.ClientError:
+            return False
+        return True
+
+    def size(self, key):
+        return self.client.head_object(Bucket=self.bucket, Key=key)['ContentLength']
+
+    def serve(self, key):
+        url = self.client.generate_presigned_url('get_object', Params={'Bucket': self.bucket, 'Key': key},
+                                                 ExpiresIn=self.url_ttl)
+        return redirect(url)
+
+if app.config['STORAGE_BACKEND'] == 's3':
+    storage = S3Storage(app.config['S3_BUCKET'], app.config['S3_ENDPOINT_URL'],
+                        app.config['S3_REGION'], app.config['S3_URL_TTL'])
+else:
+    storage = LocalStorage(app.config['UPLOAD_FOLDER'], app.config['MEDIA_ACCEL_PREFIX'])
+
+archive = None
+if app.config['ARCHIVE_FOLDER'] and isinstance(storage, LocalStorage):
+    archive = LocalStorage(app.config['ARCHIVE_FOLDER'], app.config['ARCHIVE_ACCEL_PREFIX'])
+
+def video_storage(video):
+    return archive if archive and video.storage_tier == 'archive' else storage
+
+def stored_bytes(*criteria):
+    return db.session.query(db.func.coalesce(db.func.sum(Video.size_bytes), 0)).filter(*criteria).scalar()
+
+@app.template_filter('video_type')
+def video_type_filter(key):
+    return video_mimetype(key)
+
+def media_tag(key):
+    return hashlib.md5(key.encode()).hexdigest()[:12]
+
+@app.template_filter('media_url')
+def media_url_filter(video):
+    # В адресе хэш ключа хранилища: файл по такому адресу не меняется никогда,
+    # даже если id достанется новому видео
+    return f'/media/{video.id}/{media_tag(video.filename)}'
+
+# Уровни хранения
+_promoting = set()
+_promoting_lock = threading.Lock()
+
+def move_video(video_id, tier):
+    # Копируем во временный файл рядом с целью: между дисками os.replace не работает.
+    # Строку меняем условно - если видео уже переместил другой воркер, файлы не трогаем
+    src, dst = (storage, archive) if tier == 'archive' else (archive, storage)
+    video = db.session.get(Video, video_id)
+    if not video or video.storage_tier == tier:
+        return False
+    fd, tmp_path = tempfile.mkstemp(dir=dst.root, prefix='.tier-')
+    os.close(fd)
+    try:
+        shutil.copyfile(src.path(video.filename), tmp_path)
+        dst.save(tmp_path, video.filename)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    moved = db.session.execute(update(Video).where(Video.id == video_id, Video.storage_tier != tier)
+                               .values(storage_tier=tier)).rowcount
+    db.session.commit()
+    if moved:
+        src.delete(video.filename)
+    return bool(moved)
+
+def promote_video(video_id):
+    try:
+        video = db.session.get(Video, video_id)
+        size = video.size_bytes or 0
+        # Возвращаем, только если горячий уровень не выйдет за свои пределы
+        free = shutil.disk_usage(storage.root).free - size
+        hot = stored_bytes(Video.storage_tier == 'hot') + size
+        if (free >= app.config['UPLOAD_DISK_RESERVE'] + app.config['HOT_FREE_BYTES']
+                and hot <= app.config['HOT_TIER_BYTES']):
+            move_video(video_id, 'hot')
+    except FileNotFoundError:
+        pass  # файл уже перенёс другой воркер
+    finally:
+        with _promoting_lock:
+            _promoting.discard(video_id)
+
+def request_promotion(video_id):
+    with _promoting_lock:
+        if video_id in _promoting:
+            return
+        _promoting.add(video_id)
+    run_in_background(promote_video, video_id)
+
+def backfill_sizes(batch=500):
+    # Видео, загруженные до учёта квот
+    filled = 0
+    while True:
+        videos = Video.query.filter(Video.size_bytes.is_(None)).order_by(Video.id).limit(batch).all()
+        if not videos:
+            return filled
+        for video in videos:
+            store = video_storage(video)
+            video.size_bytes = store.size(video.filename) if store.exists(video.filename) else 0
+        db.session.commit()
+        filled += len(videos)
+
+def rebalance_storage(log=lambda msg: None):
+    filled = backfill_sizes()
+    if filled:
+        log(f'Размеры заполнены: {filled}')
+    if not archive:
+        return
+    if take_lease('decay-recent-views', 24 * 3600):
+        db.session.execute(update(Video).values(recent_views=Video.recent_views // 2))
+        db.session.commit()
+
+    hot = stored_bytes(Video.storage_tier == 'hot')
+
+    def over():
+        free = shutil.disk_usage(storage.root).free
+        return (hot > app.config['HOT_TIER_BYTES']
+                or free < app.config['UPLOAD_DISK_RESERVE'] + app.config['HOT_FREE_BYTES'])
+
+    # Самые холодные первыми; свежие загрузки не трогаем, у них ещё не было шанса набрать просмотры
+    cutoff = datetime.utcnow() - app.config['TIERING_MIN_AGE']
+    last, demoted = (-1, 0), 0
+    while over():
+        rows = db.session.execute(select(Video.id, Video.recent_views, Video.size_bytes)
+                                  .where(Video.storage_tier == 'hot', Video.created_at < cutoff,
+                                         db.tuple_(Video.recent_views, Video.id) > last)
+                                  .order_by(Video.recent_views, Video.id).limit(100)).all()
+        if not rows:
+            break
+        for video_id, recent_views, size in rows:
+            last = (recent_views, video_id)
+            try:
+                if move_video(video_id, 'archive'):
+                    hot -= size or 0
+                    demoted += 1
+            except FileNotFoundError:
+                app.logger.warning('Файл видео %s не найден', video_id)
+            if not over():
+                break
+    log(f'В архив: {demoted}, на горячем уровне {hot // (1024 * 1024)} МБ')
+
+def walk_store(root):
+    # os.scandir читает каталог потоком, в памяти только стек ещё не пройденных подкаталогов
+    stack = [(root, '')]
+    while stack:
+        path, prefix = stack.pop()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((entry.path, prefix + entry.name + '/'))
+                elif entry.is_file(follow_symlinks=False):
+                    yield prefix + entry.name, entry.stat(follow_symlinks=False)
+
+def sweep_uploads(remove=False, batch=1000, rate=2000, log=lambda msg: None):
+    if not isinstance(storage, LocalStorage):
+        raise RuntimeError('Проверка работает только с локальным хранилищем')
+    run = SweepRun(deleted=remove, scanned=0, orphans=0, orphan_bytes=0, reclaimed_bytes=0, missing=0)
+    db.session.add(run)
+    db.session.commit()
+    cutoff = time.time() - app.config['SWEEP_MIN_AGE']
+    started, done = time.monotonic(), 0
+
+    def throttle(n):
+        # Не больше rate файловых операций в секунду, чтобы не мешать раздаче видео
+        nonlocal done
+        done += n
+        ahead = done / rate - (time.monotonic() - started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+    # Файлы без строки в базе (или со строкой другого уровня), включая брошенные .upload-/.tier-
+    for tier, store in [('hot', storage)] + ([('archive', archive)] if archive else []):
+        files = walk_store(store.root)
+        while True:
+            chunk = list(itertools.islice(files, batch))
+            if not chunk:
+                break
+            throttle(len(chunk))
+            known = set(db.session.execute(select(Video.filename).where(
+                Video.filename.in_([key for key, _ in chunk]), Video.storage_tier == tier)).scalars())
+            for key, st in chunk:
+                run.scanned += 1
+                if key in known or st.st_mtime > cutoff:
+                    continue
+                run.orphans += 1
+                run.orphan_bytes += st.st_size
+                log(f'Лишний файл: {tier}/{key} ({st.st_size} Б)')
+                if remove:
+                    store.delete(key)
+                    run.reclaimed_bytes += st.st_size
+            db.session.commit()
+
+    # Строки без файлов: проходим по id пачками
+    last_id = 0
+    while True:
+        rows = db.session.execute(select(Video.id, Video.filename, Video.storage_tier).where(Video.id > last_id)
+                                  .order_by(Video.id).limit(batch)).all()
+        if not rows:
+            break
+        throttle(len(rows))
+        for row in rows:
+            if not video_storage(row).exists(row.filename):
+                run.missing += 1
+                log(f'Нет файла у видео {row.id}: {row.storage_tier}/{row.filename}')
+        last_id = rows[-1].id
+
+    run.finished_at = datetime.utcnow()
+    db.session.commit()
+    return run
+
+@periodic('TIERING_SECONDS')
+def schedule_rebalance():
+    if archive and take_lease('rebalance-storage', app.config['TIERING_SECONDS']):
+        run_in_background(rebalance_storage)
+
+# Приём загрузок: файл сразу пишется во временный файл в UPLOAD_FOLDER,
+# размер проверяется по мере поступления байтов, тип - по первым килобайтам
+SNIFF_BYTES = 4096
+MULTIPART_OVERHEAD = 64 * 1024
+
+def sniff_container(head, complete=False):
+    # 'mp4' / 'webm' / None (не видео) / '' (нужно больше данных)
+    if len(head) >= 8 and head[4:8] == b'ftyp':
+        return 'mp4'
+    if head[:4] == b'\x1a\x45\xdf\xa3':
+        if b'webm' in head:
+            return 'webm'
+        if b'matroska' in head:
+            return 'mkv'
+        return None if complete or len(head) >= SNIFF_BYTES else ''
+    return None if complete or len(head) >= 8 else ''
+
+class GuardedUpload:
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.head = b''
+        self.container = ''
+        self.kept = False
+        self.file = tempfile.NamedTemporaryFile(dir=app.config['UPLOAD_FOLDER'], prefix='.upload-', delete=False)
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.limit:
+            self.reject('size')
+            raise RequestEntityTooLarge(f'Файл больше допустимых {self.limit // (1024 * 1024)} МБ')
+        if self.container == '':
+            self.head += data[:SNIFF_BYTES - len(self.head)]
+            self.container = sniff_container(self.head)
+            if self.container is None:
+                self.reject('type')
+                raise UnsupportedMediaType('Поддерживаются только видео MP4 и WebM')
+        return self.file.write(data)
+
+    def finish(self):
+        # Для файлов короче порога определения типа
+        if self.container == '':
+            self.container = sniff_container(self.head, complete=True)
+        if self.container is None:
+            self.reject('type')
+            raise UnsupportedMediaType('Поддерживаются только видео MP4 и WebM')
+        self.file.flush()
+
+    def keep(self, key):
+        self.file.close()
+        storage.save(self.file.name, key)
+        self.kept = True
+
+    def reject(self, reason):
+        inc_metric('pixtube_uploads_rejected_total', (('reason', reason),))
+        self.close()
+
+    def close(self):
+        self.file.close()
+        if not self.kept and os.path.exists(self.file.name):
+            os.remove(self.file.name)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+class PixtubeRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        limit = g.get('upload_limit')
+        if limit is None:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        return GuardedUpload(limit)
+
+app.request_class = PixtubeRequest
+
+def upload_limit(user):
+    per_file = app.config['MAX_CONTENT_LENGTH'] if user.is_admin else app.config['USER_MAX_UPLOAD_BYTES']
+    free = shutil.disk_usage(app.config['UPLOAD_FOLDER']).free - app.config['UPLOAD_DISK_RESERVE']
+    return min(per_file, free)
+
+def quota_left(user):
+    left = []
+    if not user.is_admin and app.config['USER_QUOTA_BYTES']:
+        left.append(app.config['USER_QUOTA_BYTES'] - stored_bytes(Video.user_id == user.id))
+    if app.config['TOTAL_QUOTA_BYTES']:
+        left.append(app.config['TOTAL_QUOTA_BYTES'] - stored_bytes())
+    return min(left, default=app.config['MAX_CONTENT_LENGTH'])
+
 # Главная
-@app.route('/')
-def index():
-    videos = Video.query.filter_by(is_blocked=False).all()
-    user = current_user()
-    
-    return render_template_string('''
+TEMPLATES['index.html'] = '''
 <!DOCTYPE html>
 <html>
 <head>
     <title>Pixtube - Видеохостинг</title>
-    <style>
-        /* Основные стили */
-        * {
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-            font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-        }
-        
-        body {
-            background-color: #f5f5f5;
-            color: #333;
-            line-height: 1.6;
-        }
-        
-        .container {
-            max-width: 1200px;
-            margin: 0 auto;
-            padding: 0 15px;
-        }
-        
-        /* Шапка */
-        header {
-            background: linear-gradient(135deg, #ff0000, #cc0000);
-            color: white;
-            padding: 1rem 0;
-            box-shadow: 0 2px 10px rgba(0, 0, 0, 0.1);
-            position: sticky;
-            top: 0;
-            z-index: 100;
-        }
-        
-        .header-content {
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-        }
-        
-        .logo {
-            display: flex;
-            align-items: center;
-            gap: 10px;
-            font-size: 1.8rem;
-            font-weight: bold;
-        }
-        
-        .logo i {
-            color: white;
-        }
-        
-        .nav-links {
-            display: flex;
-            gap: 20px;
-            align-items: center;
-        }
-        
-        .nav-links a {
-            color: white;
-            text-decoration: none;
-            padding: 8px 15px;
-            border-radius: 5px;
-            transition: all 0.3s ease;
-            font-weight: 500;
-        }
-        
-        .nav-links a:hover {
-            background-color: rgba(255, 255, 255, 0.2);
-        }
-        
-        .nav-links .admin-btn {
-            background-color: #ff3333;
-            color: white;
-        }
-        
-        .user-info {
-            display: flex;
-            align-items: center;
-            gap: 15px;
-        }
-        
-        .username {
-            font-weight: 600;
-        }
-        
-        /* Основной контент */
-        .main-content {
-            padding: 2rem 0;
-        }
-        
-        .welcome-section {
-            background: linear-gradient(135deg, #4285f4, #34a853);
-            color: white;
-            padding: 2rem;
-            border-radius: 10px;
-            margin-bottom: 2rem;
-            text-align: center;
-        }
-        
-        .welcome-section h1 {
-            font-size: 2.5rem;
-            margin-bottom: 1rem;
-        }
-        
-        .welcome-section p {
-            font-size: 1.2rem;
-            opacity: 0.9;
-        }
-        
-        /* Видео грид */
-        .video-grid {
-            display: grid;
-            grid-template-columns: repeat(auto-fill, minmax(280px, 1fr));
-            gap: 25px;
-            margin-top: 2rem;
-        }
-        
-        .video-card {
-            background-color: white;
-            border-radius: 10px;
-            overflow: hidden;
-            box-shadow: 0 5px 15px rgba(0, 0, 0, 0.08);
-            transition: all 0.3s ease;
-            cursor: pointer;
-        }
-        
-        .video-card:hover {
-            transform: translateY(-10px);
-            box-shadow: 0 15px 30px rgba(0, 0, 0, 0.15);
-        }
-        
-        .video-thumbnail {
-            width: 100%;
-            height: 160px;
-            background-color: #e0e0e0;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            color: #666;
-            position: relative;
-        }
-        
-        .video-thumbnail i {
-            font-size: 3rem;
-            color: #ff0000;
-        }
-        
-        .video-info {
-            padding: 15px;
-        }
-        
-        .video-title {
-            font-weight: 600;
-            font-size: 1.1rem;
-            margin-bottom: 10px;
-            color: #333;
-            display: -webkit-box;
-            -webkit-line-clamp: 2;
-            -webkit-box-orient: vertical;
-            overflow: hidden;
-        }
-        
-        .video-author {
-            color: #666;
-            font-size: 0.9rem;
-            margin-bottom: 5px;
-        }
-        
-        .video-stats {
-            display: flex;
-            justify-content: space-between;
-            color: #888;
-            font-size: 0.85rem;
-        }
-        
-        .banned-badge {
-            background-color: #ff3333;
-            color: white;
-            padding: 3px 8px;
-            border-radius: 3px;
-            font-size: 0.8rem;
-            display: inline-block;
-            margin-top: 5px;
-        }
-        
-        /* Формы */
-        .auth-container {
-            max-width: 400px;
-            margin: 50px auto;
-            padding: 30px;
-            background-color: white;
-            border-radius: 10px;
-            box-shadow: 0 10px 30px rgba(0, 0, 0, 0.1);
-        }
-        
-        .auth-container h2 {
-            text-align: center;
-            margin-bottom: 25px;
-            color: #ff0000;
-        }
-        
-        .form-group {
-            margin-bottom: 20px;
-        }
-        
-        .form-group label {
-            display: block;
-            margin-bottom: 8px;
-            font-weight: 500;
-            color: #555;
-        }
-        
-        .form-control {
-            width: 100%;
-            padding: 12px 15px;
-            border: 1px solid #ddd;
-            border-radius: 5px;
-            font-size: 1rem;
-            transition: border 0.3s;
-        }
-        
-        .form-control:focus {
-            outline: none;
-            border-color: #ff0000;
-        }
-        
-        .btn {
-            display: inline-block;
-            background-color: #ff0000;
-            color: white;
-            padding: 12px 25px;
-            border: none;
-            border-radius: 5px;
-            font-size: 1rem;
-            font-weight: 600;
-            cursor: pointer;
-            transition: all 0.3s ease;
-            text-align: center;
-            text-decoration: none;
-        }
-        
-        .btn:hover {
-            background-color: #cc0000;
-            transform: translateY(-2px);
-        }
-        
-        .btn-block {
-            width: 100%;
-        }
-        
-        .btn-secondary {
-            background-color: #4285f4;
-        }
-        
-        .btn-secondary:hover {
-            background-color: #3367d6;
-        }
-        
-        .back-link {
-            display: inline-block;
-            margin-top: 15px;
-            color: #666;
-            text-decoration: none;
-        }
-        
-        .back-link:hover {
-            color: #ff0000;
-        }
-        
-        /* Страница видео */
-        .video-page {
-            padding: 2rem 0;
-        }
-        
-        .video-player-container {
-            background-color: white;
-            border-radius: 10px;
-            padding: 20px;
-            box-shadow: 0 5px 15px rgba(0, 0, 0, 0.08);
-            margin-bottom: 2rem;
-        }
-        
-        video {
-            width: 100%;
-            border-radius: 5px;
-        }
-        
-        .video-meta {
-            margin-top: 20px;
-        }
-        
-        .video-meta h1 {
-            font-size: 1.8rem;
-            margin-bottom: 10px;
-            color: #333;
-        }
-        
-        .video-author-info {
-            display: flex;
-            align-items: center;
-            gap: 10px;
-            margin-bottom: 15px;
-        }
-        
-        .video-stats-bar {
-            display: flex;
-            gap: 20px;
-            color: #666;
-            font-size: 0.9rem;
-        }
-        
-        /* Комментарии */
-        .comments-section {
-            background-color: white;
-            border-radius: 10px;
-            padding: 20px;
-            box-shadow: 0 5px 15px rgba(0, 0, 0, 0.08);
-        }
-        
-        .comments-section h3 {
-            margin-bottom: 20px;
-            padding-bottom: 10px;
-            border-bottom: 1px solid #eee;
-        }
-        
-        .comment-form textarea {
-            width: 100%;
-            padding: 12px;
-            border: 1px solid #ddd;
-            border-radius: 5px;
-            resize: vertical;
-            min-height: 80px;
-            margin-bottom: 15px;
-        }
-        
-        .comment {
-            padding: 15px;
-            border-bottom: 1px solid #f0f0f0;
-        }
-        
-        .comment:last-child {
-            border-bottom: none;
-        }
-        
-        .comment-author {
-            font-weight: 600;
-            color: #333;
-            margin-bottom: 5px;
-        }
-        
-        .comment-content {
-            color: #555;
-            line-height: 1.5;
-        }
-        
-        .comment-actions {
-            margin-top: 10px;
-            font-size: 0.85rem;
-        }
-        
-        .comment-actions a {
-            color: #ff0000;
-            text-decoration: none;
-        }
-        
-        /* Админ панель */
-        .admin-panel {
-            padding: 2rem 0;
-        }
-        
-        .admin-section {
-            background-color: white;
-            border-radius: 10px;
-            padding: 25px;
-            margin-bottom: 2rem;
-            box-shadow: 0 5px 15px rgba(0, 0, 0, 0.08);
-        }
-        
-        .admin-section h2 {
-            color: #ff0000;
-            margin-bottom: 20px;
-            padding-bottom: 10px;
-            border-bottom: 2px solid #f0f0f0;
-        }
-        
-        .admin-table {
-            width: 100%;
-            border-collapse: collapse;
-        }
-        
-        .admin-table th {
-            background-color: #f8f8f8;
-            padding: 12px 15px;
-            text-align: left;
-            font-weight: 600;
-            color: #333;
-            border-bottom: 2px solid #eee;
-        }
-        
-        .admin-table td {
-            padding: 12px 15px;
-            border-bottom: 1px solid #eee;
-            vertical-align: top;
-        }
-        
-        .admin-table tr:hover {
-            background-color: #f9f9f9;
-        }
-        
-        .admin-table .banned {
-            background-color: #ffebee;
-        }
-        
-        .action-buttons {
-            display: flex;
-            gap: 10px;
-        }
-        
-        .action-btn {
-            padding: 5px 10px;
-            border-radius: 3px;
-            font-size: 0.85rem;
-            text-decoration: none;
-            font-weight: 500;
-        }
-        
-        .action-btn.ban {
-            background-color: #ff3333;
-            color: white;
-        }
-        
-        .action-btn.unban {
-            background-color: #34a853;
-            color: white;
-        }
-        
-        .action-btn.block {
-            background-color: #ff9800;
-            color: white;
-        }
-        
-        .action-btn.view {
-            background-color: #4285f4;
-            color: white;
-        }
-        
-        /* Футер */
-        footer {
-            background-color: #333;
-            color: white;
-            padding: 2rem 0;
-            margin-top: 3rem;
-        }
-        
-        .footer-content {
-            text-align: center;
-        }
-        
-        /* Адаптивность */
-        @media (max-width: 768px) {
-            .header-content {
-                flex-direction: column;
-                gap: 15px;
-            }
-            
-            .nav-links {
-                flex-wrap: wrap;
-                justify-content: center;
-            }
-            
-            .video-grid {
-                grid-template-columns: repeat(auto-fill, minmax(250px, 1fr));
-            }
-            
-            .admin-table {
-                display: block;
-                overflow-x: auto;
-            }
-        }
-        
-        /* Утилиты */
-        .text-center {
-            text-align: center;
-        }
-        
-        .mt-2 {
-            margin-top: 2rem;
-        }
-        
-        .mb-2 {
-            margin-bottom: 2rem;
-        }
-    </style>
-    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css">
+    <link rel="stylesheet" href="{{ asset_url('icons.css') }}">
+    <link rel="stylesheet" href="{{ asset_url('index.css') }}">
 </head>
 <body>
     <header>
@@ -667,9 +1764,51 @@ def index():
     </footer>
 </body>
 </html>
-    ''', videos=videos, user=user)
+    '''
+
+@app.route('/')
+def index():
+    user = current_user()
+    etag, last_modified = page_stamp(['index'], user)
+    if is_not_modified(etag, last_modified):
+        return stamped(Response(status=304), etag, last_modified)
+    
+    videos = Video.query.filter_by(is_blocked=False).all()
+    
+    return stamped(make_response(render_template('index.html', videos=videos, user=user)), etag, last_modified)
 
 # Регистрация
+TEMPLATES['register.html'] = '''
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <title>Регистрация - Pixtube</title>
+        <link rel="stylesheet" href="{{ asset_url('icons.css') }}">
+        <link rel="stylesheet" href="{{ asset_url('auth.css') }}">
+    </head>
+    <body>
+        <div class="auth-container">
+            <div class="logo">
+                <i class="fab fa-youtube"></i> Pixtube
+            </div>
+            <h2>Регистрация</h2>
+            <form method="POST">
+                <div class="form-group">
+                    <label for="username">Имя пользователя</label>
+                    <input type="text" id="username" name="username" class="form-control" placeholder="Введите имя" required>
+                </div>
+                <div class="form-group">
+                    <label for="password">Пароль</label>
+                    <input type="password" id="password" name="password" class="form-control" placeholder="Введите пароль" required>
+                </div>
+                <button type="submit" class="btn">Зарегистрироваться</button>
+            </form>
+            <a href="/" class="back-link"><i class="fas fa-arrow-left"></i> На главную</a>
+        </div>
+    </body>
+    </html>
+    '''
+
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
@@ -708,116 +1847,23 @@ def register():
         session['user_id'] = user.id
         return redirect('/')
     
-    return '''
+    return render_template('register.html')
+
+# Вход
+TEMPLATES['login.html'] = '''
     <!DOCTYPE html>
     <html>
     <head>
-        <title>Регистрация - Pixtube</title>
-        <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css">
-        <style>
-            * {
-                margin: 0;
-                padding: 0;
-                box-sizing: border-box;
-                font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-            }
-            
-            body {
-                background-color: #f5f5f5;
-                display: flex;
-                justify-content: center;
-                align-items: center;
-                min-height: 100vh;
-            }
-            
-            .auth-container {
-                width: 100%;
-                max-width: 400px;
-                padding: 30px;
-                background-color: white;
-                border-radius: 10px;
-                box-shadow: 0 10px 30px rgba(0, 0, 0, 0.1);
-            }
-            
-            .auth-container h2 {
-                text-align: center;
-                margin-bottom: 25px;
-                color: #ff0000;
-            }
-            
-            .form-group {
-                margin-bottom: 20px;
-            }
-            
-            .form-group label {
-                display: block;
-                margin-bottom: 8px;
-                font-weight: 500;
-                color: #555;
-            }
-            
-            .form-control {
-                width: 100%;
-                padding: 12px 15px;
-                border: 1px solid #ddd;
-                border-radius: 5px;
-                font-size: 1rem;
-                transition: border 0.3s;
-            }
-            
-            .form-control:focus {
-                outline: none;
-                border-color: #ff0000;
-            }
-            
-            .btn {
-                display: inline-block;
-                background-color: #ff0000;
-                color: white;
-                padding: 12px 25px;
-                border: none;
-                border-radius: 5px;
-                font-size: 1rem;
-                font-weight: 600;
-                cursor: pointer;
-                transition: all 0.3s ease;
-                text-align: center;
-                text-decoration: none;
-                width: 100%;
-            }
-            
-            .btn:hover {
-                background-color: #cc0000;
-                transform: translateY(-2px);
-            }
-            
-            .back-link {
-                display: block;
-                margin-top: 15px;
-                color: #666;
-                text-decoration: none;
-                text-align: center;
-            }
-            
-            .back-link:hover {
-                color: #ff0000;
-            }
-            
-            .logo {
-                text-align: center;
-                margin-bottom: 20px;
-                color: #ff0000;
-                font-size: 1.5rem;
-                font-weight: bold;
-            }
-        </style>
+        <title>Вход - Pixtube</title>
+        <link rel="stylesheet" href="{{ asset_url('icons.css') }}">
+        <link rel="stylesheet" href="{{ asset_url('auth.css') }}">
     </head>
     <body>
         <div class="auth-container">
             <div class="logo">
                 <i class="fab fa-youtube"></i> Pixtube
             </div>
-            <h2>Регистрация</h2>
+            <h2>Вход в аккаунт</h2>
             <form method="POST">
                 <div class="form-group">
                     <label for="username">Имя пользователя</label>
@@ -827,15 +1873,17 @@ def register():
                     <label for="password">Пароль</label>
                     <input type="password" id="password" name="password" class="form-control" placeholder="Введите пароль" required>
                 </div>
-                <button type="submit" class="btn">Зарегистрироваться</button>
+                <button type="submit" class="btn">Войти</button>
             </form>
+            <div class="register-link">
+                Нет аккаунта? <a href="/register">Зарегистрироваться</a>
+            </div>
             <a href="/" class="back-link"><i class="fas fa-arrow-left"></i> На главную</a>
         </div>
     </body>
     </html>
     '''
 
-# Вход
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -892,147 +1940,7 @@ def login():
         </div>
         '''
     
-    return '''
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Вход - Pixtube</title>
-        <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css">
-        <style>
-            * {
-                margin: 0;
-                padding: 0;
-                box-sizing: border-box;
-                font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-            }
-            
-            body {
-                background-color: #f5f5f5;
-                display: flex;
-                justify-content: center;
-                align-items: center;
-                min-height: 100vh;
-            }
-            
-            .auth-container {
-                width: 100%;
-                max-width: 400px;
-                padding: 30px;
-                background-color: white;
-                border-radius: 10px;
-                box-shadow: 0 10px 30px rgba(0, 0, 0, 0.1);
-            }
-            
-            .auth-container h2 {
-                text-align: center;
-                margin-bottom: 25px;
-                color: #ff0000;
-            }
-            
-            .form-group {
-                margin-bottom: 20px;
-            }
-            
-            .form-group label {
-                display: block;
-                margin-bottom: 8px;
-                font-weight: 500;
-                color: #555;
-            }
-            
-            .form-control {
-                width: 100%;
-                padding: 12px 15px;
-                border: 1px solid #ddd;
-                border-radius: 5px;
-                font-size: 1rem;
-                transition: border 0.3s;
-            }
-            
-            .form-control:focus {
-                outline: none;
-                border-color: #ff0000;
-            }
-            
-            .btn {
-                display: inline-block;
-                background-color: #ff0000;
-                color: white;
-                padding: 12px 25px;
-                border: none;
-                border-radius: 5px;
-                font-size: 1rem;
-                font-weight: 600;
-                cursor: pointer;
-                transition: all 0.3s ease;
-                text-align: center;
-                text-decoration: none;
-                width: 100%;
-            }
-            
-            .btn:hover {
-                background-color: #cc0000;
-                transform: translateY(-2px);
-            }
-            
-            .back-link {
-                display: block;
-                margin-top: 15px;
-                color: #666;
-                text-decoration: none;
-                text-align: center;
-            }
-            
-            .back-link:hover {
-                color: #ff0000;
-            }
-            
-            .logo {
-                text-align: center;
-                margin-bottom: 20px;
-                color: #ff0000;
-                font-size: 1.5rem;
-                font-weight: bold;
-            }
-            
-            .register-link {
-                text-align: center;
-                margin-top: 15px;
-                color: #666;
-            }
-            
-            .register-link a {
-                color: #ff0000;
-                text-decoration: none;
-                font-weight: 500;
-            }
-        </style>
-    </head>
-    <body>
-        <div class="auth-container">
-            <div class="logo">
-                <i class="fab fa-youtube"></i> Pixtube
-            </div>
-            <h2>Вход в аккаунт</h2>
-            <form method="POST">
-                <div class="form-group">
-                    <label for="username">Имя пользователя</label>
-                    <input type="text" id="username" name="username" class="form-control" placeholder="Введите имя" required>
-                </div>
-                <div class="form-group">
-                    <label for="password">Пароль</label>
-                    <input type="password" id="password" name="password" class="form-control" placeholder="Введите пароль" required>
-                </div>
-                <button type="submit" class="btn">Войти</button>
-            </form>
-            <div class="register-link">
-                Нет аккаунта? <a href="/register">Зарегистрироваться</a>
-            </div>
-            <a href="/" class="back-link"><i class="fas fa-arrow-left"></i> На главную</a>
-        </div>
-    </body>
-    </html>
-    '''
+    return render_template('login.html')
 
 @app.route('/logout')
 def logout():
@@ -1040,516 +1948,109 @@ def logout():
     return redirect('/')
 
 # Загрузка видео
-@app.route('/upload', methods=['GET', 'POST'])
-def upload():
-    user = current_user()
-    if not user or user.is_banned:
-        return redirect('/')
-    
-    if request.method == 'POST':
-        title = request.form['title']
-        video_file = request.files['video']
-        
-        if video_file:
-            filename = video_file.filename
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            video_file.save(filepath)
-            
-            video = Video(
-                title=title,
-                filename=filename,
-                user_id=user.id
-            )
-            db.session.add(video)
-            db.session.commit()
-            
-            return redirect('/')
-    
-    return '''
+TEMPLATES['upload.html'] = '''
     <!DOCTYPE html>
     <html>
     <head>
         <title>Загрузка видео - Pixtube</title>
-        <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css">
-        <style>
-            * {
-                margin: 0;
-                padding: 0;
-                box-sizing: border-box;
-                font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-            }
-            
-            body {
-                background-color: #f5f5f5;
-            }
-            
-            .container {
-                max-width: 800px;
-                margin: 0 auto;
-                padding: 20px;
-            }
-            
-            .upload-container {
-                background-color: white;
-                border-radius: 10px;
-                padding: 30px;
-                box-shadow: 0 10px 30px rgba(0, 0, 0, 0.1);
-            }
-            
-            .upload-container h1 {
-                color: #ff0000;
-                margin-bottom: 25px;
-                text-align: center;
-            }
-            
-            .form-group {
-                margin-bottom: 20px;
-            }
-            
-            .form-group label {
-                display: block;
-                margin-bottom: 8px;
-                font-weight: 500;
-                color: #555;
-                font-size: 1.1rem;
-            }
-            
-            .form-control {
-                width: 100%;
-                padding: 12px 15px;
-                border: 1px solid #ddd;
-                border-radius: 5px;
-                font-size: 1rem;
-                transition: border 0.3s;
-            }
-            
-            .form-control:focus {
-                outline: none;
-                border-color: #ff0000;
-            }
-            
-            .file-input {
-                padding: 15px;
-                border: 2px dashed #ddd;
-                border-radius: 5px;
-                text-align: center;
-                cursor: pointer;
-                transition: all 0.3s;
-            }
-            
-            .file-input:hover {
-                border-color: #ff0000;
-                background-color: #f9f9f9;
-            }
-            
-            .btn {
-                display: inline-block;
-                background-color: #ff0000;
-                color: white;
-                padding: 12px 25px;
-                border: none;
-                border-radius: 5px;
-                font-size: 1rem;
-                font-weight: 600;
-                cursor: pointer;
-                transition: all 0.3s ease;
-                text-align: center;
-                text-decoration: none;
-                width: 100%;
-                margin-top: 20px;
-            }
-            
-            .btn:hover {
-                background-color: #cc0000;
-                transform: translateY(-2px);
-            }
-            
-            .back-link {
-                display: inline-block;
-                margin-top: 15px;
-                color: #666;
-                text-decoration: none;
-            }
-            
-            .back-link:hover {
-                color: #ff0000;
-            }
-            
-            .logo {
-                text-align: center;
-                margin-bottom: 20px;
-                color: #ff0000;
-                font-size: 1.8rem;
-                font-weight: bold;
-            }
-            
-            .upload-icon {
-                font-size: 3rem;
-                color: #ff0000;
-                margin-bottom: 15px;
-            }
-        </style>
+        <link rel="stylesheet" href="{{ asset_url('icons.css') }}">
+        <link rel="stylesheet" href="{{ asset_url('upload.css') }}">
     </head>
     <body>
         <div class="container">
             <div class="logo">
                 <i class="fab fa-youtube"></i> Pixtube
             </div>
-            
-            <div class="upload-container">
-                <h1><i class="fas fa-cloud-upload-alt"></i> Загрузка видео</h1>
-                
-                <form method="POST" enctype="multipart/form-data">
-                    <div class="form-group">
-                        <label for="title">Название видео</label>
-                        <input type="text" id="title" name="title" class="form-control" placeholder="Введите название видео" required>
-                    </div>
-                    
-                    <div class="form-group">
-                        <label for="video">Выберите видео файл</label>
-                        <div class="file-input">
-                            <div class="upload-icon">
-                                <i class="fas fa-file-video"></i>
-                            </div>
-                            <p>Перетащите файл сюда или нажмите для выбора</p>
-                            <input type="file" id="video" name="video" accept="video/*" required style="margin-top: 10px;">
-                        </div>
-                    </div>
-                    
-                    <button type="submit" class="btn">Загрузить видео</button>
-                </form>
-                
-                <a href="/" class="back-link"><i class="fas fa-arrow-left"></i> На главную</a>
-            </div>
-        </div>
-    </body>
-    </html>
-    '''
-
-# Просмотр видео
-@app.route('/video/<int:video_id>')
-def video(video_id):
-    video = Video.query.get_or_404(video_id)
-    user = current_user()
-    
-    if video.is_blocked:
-        return '''
-        <div class="container">
-            <div style="text-align: center; padding: 50px; background-color: white; border-radius: 10px; margin-top: 50px;">
-                <i class="fas fa-ban" style="font-size: 4rem; color: #ff3333; margin-bottom: 20px;"></i>
-                <h1 style="color: #ff3333;">Видео заблокировано</h1>
-                <p style="font-size: 1.2rem; margin-top: 20px;">Это видео было заблокировано администрацией за нарушение правил платформы.</p>
-                <a href="/" class="btn" style="display: inline-block; margin-top: 20px;">Вернуться на главную</a>
-            </div>
-        </div>
-        '''
-    
-    if video.author.is_banned:
-        return '''
-        <div class="container">
-            <div style="text-align: center; padding: 50px; background-color: white; border-radius: 10px; margin-top: 50px;">
-                <i class="fas fa-user-slash" style="font-size: 4rem; color: #ff3333; margin-bottom: 20px;"></i>
-                <h1 style="color: #ff3333;">Канал автора забанен</h1>
-                <p style="font-size: 1.2rem; margin-top: 20px;">Автор этого видео был забанен за нарушение правил платформы.</p>
-                <a href="/" class="btn" style="display: inline-block; margin-top: 20px;">Вернуться на главную</a>
-            </div>
-        </div>
-        '''
-    
-    # Увеличиваем просмотры
-    video.views += 1
-    db.session.commit()
-    
-    comments = Comment.query.filter_by(video_id=video_id, is_blocked=False).all()
-    
-    return render_template_string('''
-<!DOCTYPE html>
-<html>
-<head>
-    <title>{{ video.title }} - Pixtube</title>
-    <style>
-        * {
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-            font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-        }
-        
-        body {
-            background-color: #f5f5f5;
-        }
-        
-        .container {
-            max-width: 1200px;
-            margin: 0 auto;
-            padding: 0 15px;
-        }
-        
-        /* Шапка */
-        header {
-            background: linear-gradient(135deg, #ff0000, #cc0000);
-            color: white;
-            padding: 1rem 0;
-            box-shadow: 0 2px 10px rgba(0, 0, 0, 0.1);
-        }
-        
-        .header-content {
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-        }
-        
-        .logo {
-            display: flex;
-            align-items: center;
-            gap: 10px;
-            font-size: 1.8rem;
-            font-weight: bold;
-        }
-        
-        .logo i {
-            color: white;
-        }
-        
-        .nav-links {
-            display: flex;
-            gap: 20px;
-            align-items: center;
-        }
-        
-        .nav-links a {
-            color: white;
-            text-decoration: none;
-            padding: 8px 15px;
-            border-radius: 5px;
-            transition: all 0.3s ease;
-            font-weight: 500;
-        }
-        
-        .nav-links a:hover {
-            background-color: rgba(255, 255, 255, 0.2);
-        }
-        
-        .btn {
-            display: inline-block;
-            background-color: #ff0000;
-            color: white;
-            padding: 10px 20px;
-            border: none;
-            border-radius: 5px;
-            font-size: 1rem;
-            font-weight: 600;
-            cursor: pointer;
-            transition: all 0.3s ease;
-            text-align: center;
-            text-decoration: none;
-        }
-        
-        .btn:hover {
-            background-color: #cc0000;
-            transform: translateY(-2px);
-        }
-        
-        .btn-secondary {
-            background-color: #4285f4;
-        }
-        
-        .btn-secondary:hover {
-            background-color: #3367d6;
-        }
-        
-        /* Основной контент */
-        .video-page {
-            padding: 2rem 0;
-        }
-        
-        .video-player-container {
-            background-color: white;
-            border-radius: 10px;
-            padding: 20px;
-            box-shadow: 0 5px 15px rgba(0, 0, 0, 0.08);
-            margin-bottom: 2rem;
-        }
-        
-        video {
-            width: 100%;
-            border-radius: 10px;
-            margin-bottom: 20px;
-        }
-        
-        .video-meta h1 {
-            font-size: 1.8rem;
-            margin-bottom: 15px;
-            color: #333;
-        }
-        
-        .video-author-info {
-            display: flex;
-            align-items: center;
-            gap: 15px;
-            margin-bottom: 20px;
-            padding-bottom: 15px;
-            border-bottom: 1px solid #eee;
-        }
-        
-        .author-avatar {
-            width: 50px;
-            height: 50px;
-            background-color: #4285f4;
-            border-radius: 50%;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            color: white;
-            font-size: 1.5rem;
-            font-weight: bold;
-        }
-        
-        .author-details {
-            flex-grow: 1;
-        }
-        
-        .author-name {
-            font-weight: 600;
-            font-size: 1.1rem;
-            color: #333;
-        }
-        
-        .video-stats-bar {
-            display: flex;
-            gap: 25px;
-            color: #666;
-            font-size: 1rem;
-        }
-        
-        .video-stats-bar i {
-            margin-right: 8px;
-            color: #ff0000;
-        }
-        
-        /* Комментарии */
-        .comments-section {
-            background-color: white;
-            border-radius: 10px;
-            padding: 25px;
-            box-shadow: 0 5px 15px rgba(0, 0, 0, 0.08);
-        }
-        
-        .comments-section h3 {
-            margin-bottom: 20px;
-            padding-bottom: 10px;
-            border-bottom: 2px solid #f0f0f0;
-            color: #333;
-            font-size: 1.5rem;
-        }
-        
-        .comment-form {
-            margin-bottom: 30px;
-        }
-        
-        .comment-form textarea {
-            width: 100%;
-            padding: 15px;
-            border: 1px solid #ddd;
-            border-radius: 5px;
-            resize: vertical;
-            min-height: 100px;
-            margin-bottom: 15px;
-            font-size: 1rem;
-            transition: border 0.3s;
-        }
-        
-        .comment-form textarea:focus {
-            outline: none;
-            border-color: #ff0000;
-        }
-        
-        .comment {
-            padding: 20px;
-            border-bottom: 1px solid #f0f0f0;
-            display: flex;
-            gap: 15px;
-        }
-        
-        .comment:last-child {
-            border-bottom: none;
-        }
-        
-        .comment-avatar {
-            width: 40px;
-            height: 40px;
-            background-color: #34a853;
-            border-radius: 50%;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            color: white;
-            font-weight: bold;
-            flex-shrink: 0;
-        }
-        
-        .comment-content {
-            flex-grow: 1;
-        }
-        
-        .comment-author {
-            font-weight: 600;
-            color: #333;
-            margin-bottom: 8px;
-            font-size: 1.1rem;
-        }
-        
-        .comment-text {
-            color: #555;
-            line-height: 1.6;
-            margin-bottom: 10px;
-        }
-        
-        .comment-actions {
-            font-size: 0.9rem;
-        }
-        
-        .comment-actions a {
-            color: #ff0000;
-            text-decoration: none;
-            font-weight: 500;
-        }
-        
-        .no-comments {
-            text-align: center;
-            padding: 40px;
-            color: #666;
-            font-size: 1.1rem;
-        }
-        
-        .no-comments i {
-            font-size: 3rem;
-            color: #ddd;
-            margin-bottom: 15px;
-        }
+            
+            <div class="upload-container">
+                <h1><i class="fas fa-cloud-upload-alt"></i> Загрузка видео</h1>
+                
+                <form method="POST" enctype="multipart/form-data">
+                    <div class="form-group">
+                        <label for="title">Название видео</label>
+                        <input type="text" id="title" name="title" class="form-control" placeholder="Введите название видео" required>
+                    </div>
+                    
+                    <div class="form-group">
+                        <label for="video">Выберите видео файл</label>
+                        <div class="file-input">
+                            <div class="upload-icon">
+                                <i class="fas fa-file-video"></i>
+                            </div>
+                            <p>Перетащите файл сюда или нажмите для выбора</p>
+                            <input type="file" id="video" name="video" accept="video/*" required style="margin-top: 10px;">
+                        </div>
+                    </div>
+                    
+                    <button type="submit" class="btn">Загрузить видео</button>
+                </form>
+                
+                <a href="/" class="back-link"><i class="fas fa-arrow-left"></i> На главную</a>
+            </div>
+        </div>
+    </body>
+    </html>
+    '''
+
+@app.route('/upload', methods=['GET', 'POST'])
+def upload():
+    user = current_user()
+    if not user or user.is_banned:
+        return redirect('/')
+    
+    if request.method == 'POST':
+        # Лимит выставляется до разбора формы: тело читается только внутри request.form
+        quota = quota_left(user)
+        if quota <= 0:
+            inc_metric('pixtube_uploads_rejected_total', (('reason', 'quota'),))
+            return Response('Квота на хранение видео исчерпана', status=507, mimetype='text/plain')
+        limit = upload_limit(user)
+        if limit <= 0:
+            inc_metric('pixtube_uploads_rejected_total', (('reason', 'disk'),))
+            return Response('На сервере закончилось место для видео', status=507, mimetype='text/plain')
+        limit = min(limit, quota)
+        if request.content_length and request.content_length > limit + MULTIPART_OVERHEAD:
+            inc_metric('pixtube_uploads_rejected_total', (('reason', 'size'),))
+            raise RequestEntityTooLarge(f'Файл больше допустимых {limit // (1024 * 1024)} МБ')
+        g.upload_limit = limit
         
-        /* Футер */
-        footer {
-            background-color: #333;
-            color: white;
-            padding: 2rem 0;
-            margin-top: 3rem;
-            text-align: center;
-        }
+        title = request.form['title']
+        video_file = request.files['video']
         
-        @media (max-width: 768px) {
-            .header-content {
-                flex-direction: column;
-                gap: 15px;
-            }
+        if video_file:
+            video_file.stream.finish()
+            # Уникальное имя: файлы не перезаписывают друг друга и кэшируются навсегда
+            filename = shard_key(f'{uuid.uuid4().hex}.{video_file.stream.container}')
+            video_file.stream.keep(filename)
+            observe_metric('pixtube_upload_size_bytes', video_file.stream.size)
+            observe_metric('pixtube_upload_duration_seconds', time.perf_counter() - g.request_started)
             
-            .video-stats-bar {
-                flex-direction: column;
-                gap: 10px;
-            }
-        }
-    </style>
-    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css">
+            video = Video(
+                title=title,
+                filename=filename,
+                user_id=user.id,
+                size_bytes=video_file.stream.size
+            )
+            db.session.add(video)
+            adjust_stats(user.id, videos=1)
+            db.session.flush()
+            # id мог остаться от удалённого видео (SQLite переиспользует наибольшие id),
+            # его страница не должна совпасть по ETag со старой
+            bump_stamps('index', f'user:{user.id}', f'video:{video.id}')
+            db.session.commit()
+            
+            return redirect('/')
+    
+    return render_template('upload.html')
+
+# Просмотр видео
+TEMPLATES['video.html'] = '''
+<!DOCTYPE html>
+<html>
+<head>
+    <title>{{ video.title }} - Pixtube</title>
+    <link rel="stylesheet" href="{{ asset_url('icons.css') }}">
+    <link rel="stylesheet" href="{{ asset_url('video.css') }}">
 </head>
 <body>
     <header>
@@ -1581,7 +2082,7 @@ def video(video_id):
         <div class="video-page">
             <div class="video-player-container">
                 <video controls>
-                    <source src="/static/videos/{{ video.filename }}" type="video/mp4">
+                    <source src="{{ video|media_url }}" type="{{ video.filename|video_type }}">
                     Ваш браузер не поддерживает видео тег.
                 </video>
                 
@@ -1593,9 +2094,10 @@ def video(video_id):
                             {{ video.author.username[0].upper() }}
                         </div>
                         <div class="author-details">
-                            <div class="author-name">{{ video.author.username }}</div>
+                            <a href="/user/{{ video.author.username }}" class="author-name" style="color: inherit; text-decoration: none;">{{ video.author.username }}</a>
                             <div class="video-stats-bar">
                                 <span><i class="fas fa-eye"></i> {{ video.views }} просмотров</span>
+                                <span title="Оценка, погрешность около 3%"><i class="fas fa-user"></i> ≈{{ video.unique_viewers }} зрителей</span>
                                 <span><i class="far fa-calendar"></i> {{ video.created_at.strftime('%d.%m.%Y') }}</span>
                             </div>
                         </div>
@@ -1604,12 +2106,13 @@ def video(video_id):
             </div>
             
             <div class="comments-section">
-                <h3>Комментарии ({{ comments|length }})</h3>
+                <h3>Комментарии (<span id="comment-count">{{ video.comment_count }}</span>)</h3>
                 
                 {% if user and not user.is_banned %}
                 <div class="comment-form">
-                    <form method="POST" action="/comment/{{ video.id }}">
+                    <form method="POST" action="/comment/{{ video.id }}" id="comment-form">
                         <textarea name="content" placeholder="Добавьте комментарий..." required></textarea>
+                        <p class="comment-error" hidden></p>
                         <button type="submit" class="btn">Отправить комментарий</button>
                     </form>
                 </div>
@@ -1619,24 +2122,12 @@ def video(video_id):
                 </p>
                 {% endif %}
                 
-                {% if comments %}
+                <div id="comments">
                     {% for comment in comments %}
-                    <div class="comment">
-                        <div class="comment-avatar">
-                            {{ comment.author.username[0].upper() }}
-                        </div>
-                        <div class="comment-content">
-                            <div class="comment-author">{{ comment.author.username }}</div>
-                            <div class="comment-text">{{ comment.content }}</div>
-                            <div class="comment-actions">
-                                {% if user and user.is_admin %}
-                                <a href="/admin/block_comment/{{ comment.id }}">Заблокировать</a>
-                                {% endif %}
-                            </div>
-                        </div>
-                    </div>
+                    {% include 'comment.html' %}
                     {% endfor %}
-                {% else %}
+                </div>
+                {% if not comments %}
                 <div class="no-comments">
                     <i class="far fa-comment-dots"></i>
                     <p>Пока нет комментариев. Будьте первым!</p>
@@ -1656,336 +2147,541 @@ def video(video_id):
             <p>Платформа для обмена видео</p>
         </div>
     </footer>
+    <script>
+    // События плеера копятся и уходят пачкой раз в 10 секунд и при уходе со страницы
+    (function () {
+        var player = document.querySelector('video'), queue = [];
+        function send() {
+            if (queue.length) {
+                navigator.sendBeacon('/events', JSON.stringify(queue));
+                queue = [];
+            }
+        }
+        function track(type) {
+            return function () {
+                queue.push({type: type, video: {{ video.id }}, position: player.currentTime});
+            };
+        }
+        player.addEventListener('play', track('play'));
+        player.addEventListener('seeked', track('seek'));
+        setInterval(send, 10000);
+
+        // Время просмотра: позиция раз в {{ config.HEARTBEAT_INTERVAL }} с, пока видео играет
+        var beat = {v: {{ video.id }}, p: [], first: true};
+        function sendBeat() {
+            if (beat.p.length > 1) {
+                navigator.sendBeacon('/heartbeat', JSON.stringify(beat));
+                beat = {v: {{ video.id }}, p: beat.p.slice(-1)};
+            }
+        }
+        function sample() {
+            beat.p.push(player.currentTime);
+        }
+        setInterval(function () {
+            if (!player.paused) sample();
+        }, {{ config.HEARTBEAT_INTERVAL * 1000 }});
+        setInterval(sendBeat, {{ config.HEARTBEAT_SEND_SECONDS * 1000 }});
+        player.addEventListener('play', sample);
+        player.addEventListener('pause', sample);
+        player.addEventListener('seeked', function () {
+            beat.p.push(null);
+            sample();
+        });
+
+        document.addEventListener('visibilitychange', function () {
+            if (document.visibilityState === 'hidden') {
+                send();
+                sendBeat();
+            }
+        });
+    })();
+
+    var comments = document.getElementById('comments'), commentCount = document.getElementById('comment-count');
+
+    // Комментарий появляется в списке один раз, откуда бы ни пришёл: из ответа на отправку или из SSE
+    function addComment(item) {
+        if (document.getElementById(item.id)) return;
+        comments.appendChild(item);
+        commentCount.textContent = +commentCount.textContent + 1;
+        var empty = document.querySelector('.no-comments');
+        if (empty) empty.remove();
+    }
+
+    // Отправка без перезагрузки: сервер возвращает только разметку нового комментария.
+    // Обычной отправкой формы повторяем только при сбое сети до ответа: ответ с ошибкой
+    // (429, 5xx после commit) значит, что запрос дошёл, и повтор задвоил бы комментарий
+    (function () {
+        var form = document.getElementById('comment-form');
+        if (!form || !window.fetch) return;
+        var error = form.querySelector('.comment-error');
+        form.addEventListener('submit', function (e) {
+            e.preventDefault();
+            var button = form.querySelector('button');
+            button.disabled = true;
+            error.hidden = true;
+            fetch(form.action, {
+                method: 'POST',
+                body: new FormData(form),
+                headers: {'Accept': 'text/html', 'X-Requested-With': 'XMLHttpRequest'}
+            }).then(function (response) {
+                return response.text().then(function (body) {
+                    if (!response.ok) {
+                        error.textContent = response.status === 429 ? body : 'Не удалось отправить комментарий, попробуйте позже';
+                        error.hidden = false;
+                        return;
+                    }
+                    var template = document.createElement('template');
+                    template.innerHTML = body.trim();
+                    addComment(template.content.firstElementChild);
+                    form.reset();
+                });
+            }, function () {
+                form.submit();
+            }).finally(function () {
+                button.disabled = false;
+            });
+        });
+    })();
+
+    // Новые комментарии других зрителей без перезагрузки страницы
+    (function () {
+        if (!window.EventSource) return;
+        function element(tag, cls, text) {
+            var el = document.createElement(tag);
+            el.className = cls;
+            if (text !== undefined) el.textContent = text;
+            return el;
+        }
+        new EventSource('/video/{{ video.id }}/events').addEventListener('comment', function (e) {
+            var c = JSON.parse(e.data);
+            var item = element('div', 'comment'), body = element('div', 'comment-content');
+            var actions = element('div', 'comment-actions');
+            item.id = 'comment-' + c.id;
+            {% if user and user.is_admin %}
+            var block = element('a', '', 'Заблокировать');
+            block.href = '/admin/block_comment/' + c.id;
+            actions.appendChild(block);
+            {% endif %}
+            body.appendChild(element('div', 'comment-author', c.author));
+            body.appendChild(element('div', 'comment-text', c.content));
+            body.appendChild(actions);
+            item.appendChild(element('div', 'comment-avatar', c.author[0].toUpperCase()));
+            item.appendChild(body);
+            addComment(item);
+        });
+    })();
+    </script>
 </body>
 </html>
-    ''', video=video, comments=comments, user=user)
+    '''
 
-# Комментарий
-@app.route('/comment/<int:video_id>', methods=['POST'])
-def add_comment(video_id):
+@app.route('/video/<int:video_id>')
+def video(video_id):
+    video = Video.query.get_or_404(video_id)
     user = current_user()
-    if not user or user.is_banned:
-        return redirect('/')
     
-    content = request.form['content']
-    comment = Comment(
-        content=content,
-        user_id=user.id,
-        video_id=video_id
-    )
-    db.session.add(comment)
+    if video.is_blocked:
+        return '''
+        <div class="container">
+            <div style="text-align: center; padding: 50px; background-color: white; border-radius: 10px; margin-top: 50px;">
+                <i class="fas fa-ban" style="font-size: 4rem; color: #ff3333; margin-bottom: 20px;"></i>
+                <h1 style="color: #ff3333;">Видео заблокировано</h1>
+                <p style="font-size: 1.2rem; margin-top: 20px;">Это видео было заблокировано администрацией за нарушение правил платформы.</p>
+                <a href="/" class="btn" style="display: inline-block; margin-top: 20px;">Вернуться на главную</a>
+            </div>
+        </div>
+        '''
+    
+    if video.author.is_banned:
+        return '''
+        <div class="container">
+            <div style="text-align: center; padding: 50px; background-color: white; border-radius: 10px; margin-top: 50px;">
+                <i class="fas fa-user-slash" style="font-size: 4rem; color: #ff3333; margin-bottom: 20px;"></i>
+                <h1 style="color: #ff3333;">Канал автора забанен</h1>
+                <p style="font-size: 1.2rem; margin-top: 20px;">Автор этого видео был забанен за нарушение правил платформы.</p>
+                <a href="/" class="btn" style="display: inline-block; margin-top: 20px;">Вернуться на главную</a>
+            </div>
+        </div>
+        '''
+    
+    # Увеличиваем просмотры
+    video.views += 1
+    video.recent_views += 1
     db.session.commit()
+    record_author_view(video.user_id)
+    inc_metric('pixtube_video_views_total')
+    log_event('view', video_id)
+    record_viewer(video_id, f'u{user.id}' if user else f'a{request.remote_addr} {request.user_agent.string}')
     
-    return redirect(f'/video/{video_id}')
-
-# АДМИНКА
-@app.route('/admin')
-def admin():
-    user = current_user()
-    if not user or not user.is_admin:
-        return redirect('/')
+    etag, last_modified = page_stamp([f'video:{video_id}', f'user:{video.user_id}'], user)
+    if is_not_modified(etag, last_modified):
+        return stamped(Response(status=304), etag, last_modified)
     
-    videos = Video.query.all()
-    users = User.query.all()
-    comments = Comment.query.all()
+    comments = Comment.query.filter_by(video_id=video_id, is_blocked=False).all()
     
-    return render_template_string('''
+    return stamped(make_response(render_template('video.html', video=video, comments=comments, user=user)), etag, last_modified)
+
+# Файл видео: проверки как в video(), дальше отдаёт хранилище.
+# Адрес без хэша ключа (старые страницы) работает, но не кэшируется надолго
+@app.route('/media/<int:video_id>')
+@app.route('/media/<int:video_id>/<tag>')
+def media(video_id, tag=None):
+    video = Video.query.get_or_404(video_id)
+    if tag is not None and tag != media_tag(video.filename):
+        abort(404)
+    if video.is_blocked or video.author.is_banned:
+        abort(403)
+    store = video_storage(video)
+    if store is archive:
+        request_promotion(video.id)
+        # Пока строка читалась, видео могли уже вернуть на горячий уровень
+        if not archive.exists(video.filename):
+            store = storage
+    return store.serve(video.filename)
+
+# Канал автора: счётчики из UserStats, видео страницами по id (before - последний id прошлой страницы)
+TEMPLATES['channel.html'] = '''
 <!DOCTYPE html>
 <html>
 <head>
-    <title>Админ панель - Pixtube</title>
-    <style>
-        * {
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-            font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-        }
-        
-        body {
-            background-color: #f5f5f5;
-        }
-        
-        .container {
-            max-width: 1400px;
-            margin: 0 auto;
-            padding: 0 15px;
-        }
-        
-        /* Шапка */
-        header {
-            background: linear-gradient(135deg, #333, #222);
-            color: white;
-            padding: 1rem 0;
-            box-shadow: 0 2px 10px rgba(0, 0, 0, 0.1);
-        }
-        
-        .header-content {
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-        }
-        
-        .logo {
-            display: flex;
-            align-items: center;
-            gap: 10px;
-            font-size: 1.8rem;
-            font-weight: bold;
-        }
-        
-        .logo i {
-            color: #ff0000;
-        }
-        
-        .nav-links {
-            display: flex;
-            gap: 20px;
-            align-items: center;
-        }
-        
-        .nav-links a {
-            color: white;
-            text-decoration: none;
-            padding: 8px 15px;
-            border-radius: 5px;
-            transition: all 0.3s ease;
-            font-weight: 500;
-        }
-        
-        .nav-links a:hover {
-            background-color: rgba(255, 255, 255, 0.2);
-        }
-        
-        .btn {
-            display: inline-block;
-            background-color: #ff0000;
-            color: white;
-            padding: 10px 20px;
-            border: none;
-            border-radius: 5px;
-            font-size: 1rem;
-            font-weight: 600;
-            cursor: pointer;
-            transition: all 0.3s ease;
-            text-align: center;
-            text-decoration: none;
-        }
-        
-        .btn:hover {
-            background-color: #cc0000;
-            transform: translateY(-2px);
-        }
-        
-        /* Админ панель */
-        .admin-panel {
-            padding: 2rem 0;
-        }
-        
-        .admin-header {
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-            margin-bottom: 2rem;
-        }
-        
-        .admin-header h1 {
-            color: #333;
-        }
-        
-        .admin-section {
-            background-color: white;
-            border-radius: 10px;
-            padding: 25px;
-            margin-bottom: 2rem;
-            box-shadow: 0 5px 15px rgba(0, 0, 0, 0.08);
-        }
-        
-        .admin-section h2 {
-            color: #ff0000;
-            margin-bottom: 20px;
-            padding-bottom: 10px;
-            border-bottom: 2px solid #f0f0f0;
-            display: flex;
-            align-items: center;
-            gap: 10px;
-        }
-        
-        .admin-section h2 i {
-            color: #ff0000;
-        }
-        
-        .admin-table {
-            width: 100%;
-            border-collapse: collapse;
-        }
-        
-        .admin-table th {
-            background-color: #f8f8f8;
-            padding: 15px;
-            text-align: left;
-            font-weight: 600;
-            color: #333;
-            border-bottom: 2px solid #eee;
-            font-size: 0.95rem;
-        }
-        
-        .admin-table td {
-            padding: 15px;
-            border-bottom: 1px solid #eee;
-            vertical-align: top;
-            font-size: 0.9rem;
-        }
-        
-        .admin-table tr:hover {
-            background-color: #f9f9f9;
-        }
-        
-        .admin-table .banned {
-            background-color: #ffebee;
-        }
-        
-        .admin-table .admin-user {
-            background-color: #e8f5e9;
-        }
-        
-        .action-buttons {
-            display: flex;
-            gap: 8px;
-            flex-wrap: wrap;
-        }
-        
-        .action-btn {
-            padding: 6px 12px;
-            border-radius: 4px;
-            font-size: 0.85rem;
-            text-decoration: none;
-            font-weight: 500;
-            transition: all 0.3s;
-            white-space: nowrap;
-        }
-        
-        .action-btn.ban {
-            background-color: #ff3333;
-            color: white;
-        }
-        
-        .action-btn.ban:hover {
-            background-color: #d32f2f;
-        }
-        
-        .action-btn.unban {
-            background-color: #34a853;
-            color: white;
-        }
-        
-        .action-btn.unban:hover {
-            background-color: #2e7d32;
-        }
-        
-        .action-btn.block {
-            background-color: #ff9800;
-            color: white;
-        }
-        
-        .action-btn.block:hover {
-            background-color: #ef6c00;
-        }
-        
-        .action-btn.unblock {
-            background-color: #4285f4;
-            color: white;
-        }
-        
-        .action-btn.unblock:hover {
-            background-color: #3367d6;
-        }
-        
-        .action-btn.view {
-            background-color: #9c27b0;
-            color: white;
-        }
-        
-        .action-btn.view:hover {
-            background-color: #7b1fa2;
-        }
-        
-        .user-status {
-            display: inline-block;
-            padding: 4px 10px;
-            border-radius: 20px;
-            font-size: 0.8rem;
-            font-weight: 500;
-        }
-        
-        .status-admin {
-            background-color: #4caf50;
-            color: white;
-        }
-        
-        .status-banned {
-            background-color: #f44336;
-            color: white;
-        }
-        
-        .status-normal {
-            background-color: #2196f3;
-            color: white;
-        }
-        
-        .video-status {
-            display: inline-block;
-            padding: 4px 10px;
-            border-radius: 20px;
-            font-size: 0.8rem;
-            font-weight: 500;
-        }
-        
-        .status-blocked {
-            background-color: #ff9800;
-            color: white;
-        }
-        
-        .status-active {
-            background-color: #4caf50;
-            color: white;
-        }
-        
-        /* Футер */
-        footer {
-            background-color: #333;
-            color: white;
-            padding: 2rem 0;
-            margin-top: 3rem;
-            text-align: center;
-        }
-        
-        /* Адаптивность */
-        @media (max-width: 1024px) {
-            .admin-table {
-                display: block;
-                overflow-x: auto;
-            }
-        }
-        
-        @media (max-width: 768px) {
-            .header-content {
-                flex-direction: column;
-                gap: 15px;
-            }
+    <title>{{ author.username }} - Pixtube</title>
+    <link rel="stylesheet" href="{{ asset_url('icons.css') }}">
+    <link rel="stylesheet" href="{{ asset_url('index.css') }}">
+</head>
+<body>
+    <header>
+        <div class="container">
+            <div class="header-content">
+                <a href="/" class="logo" style="color: white; text-decoration: none;">
+                    <i class="fab fa-youtube"></i>
+                    <span>Pixtube</span>
+                </a>
+                
+                <div class="nav-links">
+                    {% if user %}
+                        <div class="user-info">
+                            <span class="username">{{ user.username }}</span>
+                            <a href="/upload" class="btn">Загрузить видео</a>
+                            {% if user.is_admin %}
+                                <a href="/admin" class="btn admin-btn"><i class="fas fa-crown"></i> Админка</a>
+                            {% endif %}
+                            <a href="/logout" class="btn btn-secondary">Выйти</a>
+                        </div>
+                    {% else %}
+                        <a href="/login" class="btn">Войти</a>
+                        <a href="/register" class="btn btn-secondary">Регистрация</a>
+                    {% endif %}
+                </div>
+            </div>
+        </div>
+    </header>
+    
+    <div class="container">
+        <div class="main-content">
+            <div class="channel-header">
+                <div class="channel-avatar">{{ author.username[0].upper() }}</div>
+                <div>
+                    <h1>{{ author.username }}</h1>
+                    <div class="video-stats-bar">
+                        <span><i class="fas fa-video"></i> {{ stats.video_count }} видео</span>
+                        <span><i class="fas fa-eye"></i> {{ stats.total_views }} просмотров</span>
+                    </div>
+                    {% if author.is_banned %}
+                    <div class="banned-badge">
+                        <i class="fas fa-ban"></i> Канал забанен
+                    </div>
+                    {% endif %}
+                </div>
+            </div>
             
-            .admin-header {
-                flex-direction: column;
-                align-items: flex-start;
-                gap: 15px;
-            }
+            <div class="video-grid">
+                {% for video in videos %}
+                <a href="/video/{{ video.id }}" style="text-decoration: none;">
+                    <div class="video-card">
+                        <div class="video-thumbnail">
+                            <i class="fas fa-play-circle"></i>
+                        </div>
+                        <div class="video-info">
+                            <h3 class="video-title">{{ video.title }}</h3>
+                            <div class="video-stats">
+                                <span><i class="fas fa-eye"></i> {{ video.views }}</span>
+                                <span><i class="far fa-clock"></i> {{ video.created_at.strftime('%d.%m.%Y') }}</span>
+                            </div>
+                        </div>
+                    </div>
+                </a>
+                {% endfor %}
+            </div>
             
-            .action-buttons {
-                flex-direction: column;
-            }
-        }
-    </style>
-    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css">
+            {% if videos|length == 0 %}
+            <div class="text-center mt-2">
+                <p style="font-size: 1.2rem; color: #666;">На канале пока нет видео.</p>
+            </div>
+            {% endif %}
+            
+            {% if next_before %}
+            <div class="text-center mt-2">
+                <a href="?before={{ next_before }}" class="btn">Ещё видео</a>
+            </div>
+            {% endif %}
+        </div>
+    </div>
+    
+    <footer>
+        <div class="container">
+            <div class="footer-content">
+                <p>© 2023 Pixtube. Все права защищены.</p>
+                <p>Платформа для обмена видео</p>
+            </div>
+        </div>
+    </footer>
+</body>
+</html>
+    '''
+
+@app.route('/user/<username>')
+def channel(username):
+    author = User.query.filter_by(username=username).first_or_404()
+    user = current_user()
+    before = request.args.get('before', type=int)
+    etag, last_modified = page_stamp([f'user:{author.id}'], user)
+    etag = f'{etag}-{before or 0}'
+    if is_not_modified(etag, last_modified):
+        return stamped(Response(status=304), etag, last_modified)
+    
+    stats = user_stats(author.id)
+    db.session.commit()
+    query = Video.query.filter_by(user_id=author.id, is_blocked=False)
+    if before:
+        query = query.filter(Video.id < before)
+    videos = query.order_by(Video.id.desc()).limit(app.config['CHANNEL_PAGE_SIZE'] + 1).all()
+    next_before = videos[-2].id if len(videos) > app.config['CHANNEL_PAGE_SIZE'] else None
+    videos = videos[:app.config['CHANNEL_PAGE_SIZE']]
+    
+    return stamped(make_response(render_template('channel.html', author=author, stats=stats, videos=videos, next_before=next_before, user=user)), etag, last_modified)
+
+# События плеера пачкой JSON: [{"type": "seek", "video": 1, "position": 12.5}, ...].
+# Только запись в буфер журнала, без запросов к базе
+@app.route('/events', methods=['POST'])
+def client_events():
+    if (request.content_length or 0) > 64 * 1024:
+        abort(413)
+    # sendBeacon присылает JSON как text/plain
+    events = request.get_json(force=True, silent=True)
+    if not isinstance(events, list) or len(events) > 100:
+        abort(400)
+    for e in events:
+        if isinstance(e, dict) and e.get('type') in ('play', 'seek') and valid_id(e.get('video')):
+            position = e.get('position')
+            log_event(e['type'], e['video'], round(position, 1) if type(position) in (int, float) else '')
+    return '', 204
+
+# Heartbeat плеера: {"v": id видео, "p": [позиции], "first": true в первой пачке сессии}.
+# Пачка начинается с последней позиции предыдущей, поэтому считается без состояния сессии
+# на сервере и в любом воркере; null в позициях - перемотка, разрыв не засчитывается
+@app.route('/heartbeat', methods=['POST'])
+def heartbeat():
+    if (request.content_length or 0) > 16 * 1024:
+        abort(413)
+    beat = request.get_json(force=True, silent=True)
+    if (not isinstance(beat, dict) or not valid_id(beat.get('v'))
+            or not isinstance(beat.get('p'), list) or len(beat['p']) > 500):
+        abort(400)
+    # Шаг больше двух интервалов - не просмотр, а перемотка или потерянная пачка
+    limit = 2 * app.config['HEARTBEAT_INTERVAL']
+    watched, previous = 0.0, None
+    for position in beat['p']:
+        if type(position) not in (int, float):
+            previous = None
+            continue
+        if previous is not None and 0 < position - previous <= limit:
+            watched += position - previous
+        previous = position
+    record_watch(beat['v'], min(watched, app.config['HEARTBEAT_MAX_SECONDS']), beat.get('first') is True)
+    return '', 204
+
+# Живые комментарии: add_comment() пишет строку в comment_feed общей базы, в каждом воркере
+# один поток читает ленту и раскладывает строки по очередям подписчиков своего процесса.
+# Тысяча зрителей одного видео - одно чтение ленты на воркер, а не тысяча запросов к базе
+_subscribers = {}  # id видео -> множество очередей открытых SSE-соединений
+_subscribers_lock = threading.Lock()
+_feed_poller = {'pid': None}
+_stream_slots = threading.BoundedSemaphore(app.config['SSE_MAX_STREAMS'])
+_stream_allowed = {}  # id видео -> (можно ли слушать или None, если видео нет; до какого момента верно)
+_stream_allowed_lock = threading.Lock()
+
+def publish_comment(comment):
+    # Вызывать после commit, чтобы подписчики не увидели откатившийся комментарий
+    data = json.dumps({'id': comment.id, 'author': comment.author.username, 'content': comment.content},
+                      ensure_ascii=False)
+    shared_db().execute('INSERT INTO comment_feed (video_id, data, created) VALUES (?, ?, ?)',
+                        (comment.video_id, data, time.time()))
+
+def poll_comment_feed():
+    last_seq = shared_db().execute('SELECT coalesce(max(seq), 0) FROM comment_feed').fetchone()[0]
+    while True:
+        time.sleep(app.config['COMMENT_FEED_POLL'])
+        try:
+            rows = shared_db().execute('SELECT seq, video_id, data FROM comment_feed WHERE seq > ? ORDER BY seq',
+                                       (last_seq,)).fetchall()
+        except sqlite3.Error:
+            app.logger.exception('Лента комментариев недоступна')
+            continue
+        for seq, video_id, data in rows:
+            with _subscribers_lock:
+                queues = list(_subscribers.get(video_id, ()))
+            for q in queues:
+                q.put((seq, data))
+            last_seq = seq
+
+def subscribe(video_id):
+    # Поток опроса запускается в процессе при первой подписке (после fork, не в мастере)
+    q = queue.Queue()
+    with _subscribers_lock:
+        if _feed_poller['pid'] != os.getpid():
+            _feed_poller['pid'] = os.getpid()
+            threading.Thread(target=poll_comment_feed, daemon=True).start()
+        _subscribers.setdefault(video_id, set()).add(q)
+    return q
+
+def unsubscribe(video_id, q):
+    with _subscribers_lock:
+        _subscribers[video_id].discard(q)
+        if not _subscribers[video_id]:
+            del _subscribers[video_id]
+
+@periodic('COMMENT_FEED_PRUNE_SECONDS')
+def prune_comment_feed():
+    # Старые строки нужны только для переподключения по Last-Event-ID
+    shared_db().execute('DELETE FROM comment_feed WHERE created < ?',
+                        (time.time() - app.config['COMMENT_FEED_KEEP_SECONDS'],))
+
+def stream_allowed(video_id):
+    now = time.monotonic()
+    with _stream_allowed_lock:
+        cached = _stream_allowed.get(video_id)
+    if cached and cached[1] > now:
+        return cached[0]
+    row = db.session.execute(select(Video.is_blocked, User.is_banned).join(User, User.id == Video.user_id)
+                             .where(Video.id == video_id)).first()
+    allowed = None if row is None else not (row.is_blocked or row.is_banned)
+    with _stream_allowed_lock:
+        # Несуществующие id тоже запоминаются - чтобы словарь не рос без конца, сбрасываем его целиком
+        if len(_stream_allowed) >= app.config['SSE_CHECK_CACHE_SIZE']:
+            _stream_allowed.clear()
+        _stream_allowed[video_id] = (allowed, now + app.config['SSE_CHECK_SECONDS'])
+    return allowed
+
+def sse_message(seq, data):
+    return f'id: {seq}\nevent: comment\ndata: {data}\n\n'
+
+@app.route('/video/<int:video_id>/events')
+def comment_stream(video_id):
+    allowed = stream_allowed(video_id)
+    if allowed is None:
+        abort(404)
+    if not allowed:
+        abort(403)
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    db.session.remove()  # соединение с базой не держим всё время потока
+
+    def stream():
+        # Открытый поток занимает поток gunicorn целиком. Сверх SSE_MAX_STREAMS соединение
+        # отдаёт пропущенное и закрывается, браузер сам придёт снова через SSE_POLL_SECONDS
+        live = _stream_slots.acquire(blocking=False)
+        q = subscribe(video_id) if live else None
+        try:
+            yield f"retry: {(5 if live else app.config['SSE_POLL_SECONDS']) * 1000}\n\n"
+            sent = last_id or 0
+            if last_id is not None:
+                # Пропущенное за время переподключения
+                for seq, data in shared_db().execute('SELECT seq, data FROM comment_feed WHERE video_id = ? '
+                                                     'AND seq > ? ORDER BY seq', (video_id, last_id)).fetchall():
+                    yield sse_message(seq, data)
+                    sent = seq
+            elif not live:
+                # Только запомнить позицию ленты: с ней браузер переподключится
+                sent = shared_db().execute('SELECT coalesce(max(seq), 0) FROM comment_feed').fetchone()[0]
+                yield f'id: {sent}\n\n'
+            if not live:
+                inc_metric('pixtube_sse_polls_total')
+                return
+            deadline = time.monotonic() + app.config['SSE_MAX_SECONDS']
+            while time.monotonic() < deadline:
+                try:
+                    seq, data = q.get(timeout=app.config['SSE_PING_SECONDS'])
+                except queue.Empty:
+                    yield ': ping\n\n'
+                    continue
+                if seq > sent:
+                    yield sse_message(seq, data)
+                    sent = seq
+        finally:
+            if live:
+                unsubscribe(video_id, q)
+                _stream_slots.release()
+
+    response = Response(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # nginx не должен копить поток
+    return response
+
+# Комментарий. Форма страницы видео получает редирект обратно на страницу, запрос из её скрипта
+# (X-Requested-With) - только разметку нового комментария, клиент с Accept: application/json - JSON
+TEMPLATES['comment.html'] = '''
+<div class="comment" id="comment-{{ comment.id }}">
+    <div class="comment-avatar">
+        {{ comment.author.username[0].upper() }}
+    </div>
+    <div class="comment-content">
+        <div class="comment-author">{{ comment.author.username }}</div>
+        <div class="comment-text">{{ comment.content }}</div>
+        <div class="comment-actions">
+            {% if user and user.is_admin %}
+            <a href="/admin/block_comment/{{ comment.id }}">Заблокировать</a>
+            {% endif %}
+        </div>
+    </div>
+</div>
+'''
+
+@app.route('/comment/<int:video_id>', methods=['POST'])
+def add_comment(video_id):
+    user = current_user()
+    wants_json = request.accept_mimetypes.best_match(['text/html', 'application/json']) == 'application/json'
+    partial = wants_json or request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+    if not user or user.is_banned:
+        if partial:
+            abort(403)
+        return redirect('/')
+    
+    content = request.form['content']
+    comment = Comment(
+        content=content,
+        user_id=user.id,
+        video_id=video_id
+    )
+    db.session.add(comment)
+    change_comment_count(video_id, 1)
+    bump_stamps(f'video:{video_id}')
+    db.session.commit()
+    publish_comment(comment)
+    
+    if wants_json:
+        return jsonify(id=comment.id, video_id=video_id, author=user.username, content=comment.content,
+                       created_at=comment.created_at.isoformat()), 201
+    if partial:
+        return render_template('comment.html', comment=comment, user=user), 201
+    return redirect(f'/video/{video_id}')
+
+# АДМИНКА
+TEMPLATES['admin.html'] = '''
+<!DOCTYPE html>
+<html>
+<head>
+    <title>Админ панель - Pixtube</title>
+    <link rel="stylesheet" href="{{ asset_url('icons.css') }}">
+    <link rel="stylesheet" href="{{ asset_url('admin.css') }}">
 </head>
 <body>
     <header>
@@ -2010,13 +2706,20 @@ def admin():
             <div class="admin-header">
                 <h1><i class="fas fa-crown"></i> Панель администратора</h1>
                 <p>Всего: {{ users|length }} пользователей, {{ videos|length }} видео, {{ comments|length }} комментариев</p>
+                <a href="/admin/dashboard" class="btn"><i class="fas fa-eye"></i> Статистика</a>
             </div>
             
             <div class="admin-section">
                 <h2><i class="fas fa-users"></i> Пользователи</h2>
+                <form method="POST" action="/admin/bulk/users">
+                <div class="bulk-actions">
+                    <button type="submit" name="action" value="ban" class="action-btn ban"><i class="fas fa-user-slash"></i> Забанить выбранных</button>
+                    <button type="submit" name="action" value="unban" class="action-btn unban"><i class="fas fa-user-check"></i> Разбанить выбранных</button>
+                </div>
                 <table class="admin-table">
                     <thead>
                         <tr>
+                            <th><input type="checkbox" class="select-all"></th>
                             <th>ID</th>
                             <th>Имя пользователя</th>
                             <th>Статус</th>
@@ -2026,6 +2729,7 @@ def admin():
                     <tbody>
                         {% for u in users %}
                         <tr class="{% if u.is_banned %}banned{% elif u.is_admin %}admin-user{% endif %}">
+                            <td>{% if not u.is_admin %}<input type="checkbox" name="ids" value="{{ u.id }}">{% endif %}</td>
                             <td>{{ u.id }}</td>
                             <td>{{ u.username }}</td>
                             <td>
@@ -2045,6 +2749,7 @@ def admin():
                                         {% else %}
                                         <a href="/admin/ban/{{ u.id }}" class="action-btn ban"><i class="fas fa-user-slash"></i> Забанить</a>
                                         {% endif %}
+                                        <button type="submit" form="comments-by-author" name="author" value="{{ u.id }}" class="action-btn block"><i class="fas fa-comment-slash"></i> Скрыть комментарии</button>
                                     {% else %}
                                     <span style="color: #666; font-size: 0.85rem;">Нет действий</span>
                                     {% endif %}
@@ -2054,13 +2759,23 @@ def admin():
                         {% endfor %}
                     </tbody>
                 </table>
+                </form>
+                <form method="POST" action="/admin/bulk/comments" id="comments-by-author">
+                    <input type="hidden" name="action" value="block">
+                </form>
             </div>
             
             <div class="admin-section">
                 <h2><i class="fas fa-video"></i> Видео</h2>
+                <form method="POST" action="/admin/bulk/videos">
+                <div class="bulk-actions">
+                    <button type="submit" name="action" value="block" class="action-btn block"><i class="fas fa-lock"></i> Заблокировать выбранные</button>
+                    <button type="submit" name="action" value="unblock" class="action-btn unblock"><i class="fas fa-unlock"></i> Разблокировать выбранные</button>
+                </div>
                 <table class="admin-table">
                     <thead>
                         <tr>
+                            <th><input type="checkbox" class="select-all"></th>
                             <th>ID</th>
                             <th>Название</th>
                             <th>Автор</th>
@@ -2072,6 +2787,7 @@ def admin():
                     <tbody>
                         {% for v in videos %}
                         <tr class="{% if v.is_blocked %}banned{% endif %}">
+                            <td><input type="checkbox" name="ids" value="{{ v.id }}"></td>
                             <td>{{ v.id }}</td>
                             <td>{{ v.title[:50] }}{% if v.title|length > 50 %}...{% endif %}</td>
                             <td>{{ v.author.username }}</td>
@@ -2097,13 +2813,20 @@ def admin():
                         {% endfor %}
                     </tbody>
                 </table>
+                </form>
             </div>
             
             <div class="admin-section">
                 <h2><i class="fas fa-comments"></i> Комментарии</h2>
+                <form method="POST" action="/admin/bulk/comments">
+                <div class="bulk-actions">
+                    <button type="submit" name="action" value="block" class="action-btn block"><i class="fas fa-lock"></i> Заблокировать выбранные</button>
+                    <button type="submit" name="action" value="unblock" class="action-btn unblock"><i class="fas fa-unlock"></i> Разблокировать выбранные</button>
+                </div>
                 <table class="admin-table">
                     <thead>
                         <tr>
+                            <th><input type="checkbox" class="select-all"></th>
                             <th>ID</th>
                             <th>Текст</th>
                             <th>Автор</th>
@@ -2115,10 +2838,11 @@ def admin():
                     <tbody>
                         {% for c in comments %}
                         <tr class="{% if c.is_blocked %}banned{% endif %}">
+                            <td><input type="checkbox" name="ids" value="{{ c.id }}"></td>
                             <td>{{ c.id }}</td>
                             <td>{{ c.content[:80] }}{% if c.content|length > 80 %}...{% endif %}</td>
                             <td>{{ c.author.username }}</td>
-                            <td>{{ c.video.title[:30] }}{% if c.video.title|length > 30 %}...{% endif %}</td>
+                            <td>{% if c.video %}{{ c.video.title[:30] }}{% if c.video.title|length > 30 %}...{% endif %}{% else %}<i>удалено</i>{% endif %}</td>
                             <td>
                                 {% if c.is_blocked %}
                                 <span class="video-status status-blocked"><i class="fas fa-ban"></i> Заблокирован</span>
@@ -2139,6 +2863,7 @@ def admin():
                         {% endfor %}
                     </tbody>
                 </table>
+                </form>
             </div>
         </div>
     </div>
@@ -2149,32 +2874,210 @@ def admin():
             <p>Только для авторизованных администраторов.</p>
         </div>
     </footer>
+    <script>
+    // Флажок в заголовке таблицы отмечает все строки этой таблицы
+    document.querySelectorAll('.select-all').forEach(function (all) {
+        all.addEventListener('change', function () {
+            all.closest('table').querySelectorAll('input[name=ids]').forEach(function (box) {
+                box.checked = all.checked;
+            });
+        });
+    });
+    </script>
+</body>
+</html>
+    '''
+
+@app.route('/admin')
+def admin():
+    user = current_user()
+    if not user or not user.is_admin:
+        return redirect('/')
+    
+    videos = Video.query.all()
+    users = User.query.all()
+    comments = Comment.query.all()
+    
+    return render_template('admin.html', videos=videos, users=users, comments=comments, user=user)  # ИСПРАВЛЕНО: добавлен user=user
+
+# Статистика: читает только готовые сводки, объём истории на стоимость страницы не влияет
+TEMPLATES['admin_dashboard.html'] = '''
+<!DOCTYPE html>
+<html>
+<head>
+    <title>Статистика - Pixtube</title>
+    <link rel="stylesheet" href="{{ asset_url('icons.css') }}">
+    <link rel="stylesheet" href="{{ asset_url('admin.css') }}">
+</head>
+<body>
+    <header>
+        <div class="container">
+            <div class="header-content">
+                <a href="/" class="logo" style="text-decoration: none; color: white;">
+                    <i class="fab fa-youtube"></i>
+                    <span>Pixtube Админ</span>
+                </a>
+                
+                <div class="nav-links">
+                    <span style="font-weight: 500;">{{ user.username }} (Администратор)</span>
+                    <a href="/admin" class="btn">Админка</a>
+                    <a href="/logout" class="btn">Выйти</a>
+                </div>
+            </div>
+        </div>
+    </header>
+    
+    <div class="container">
+        <div class="admin-panel">
+            <div class="admin-header">
+                <h1><i class="fas fa-eye"></i> Статистика</h1>
+                <p>Сводка обновляется раз в {{ config.ROLLUP_SECONDS // 60 }} мин.</p>
+            </div>
+            
+            <div class="admin-section">
+                <h2><i class="fas fa-play-circle"></i> Популярное за {{ config.TOP_VIDEOS_DAYS }} дней</h2>
+                <table class="admin-table">
+                    <thead>
+                        <tr>
+                            <th>#</th>
+                            <th>Название</th>
+                            <th>Просмотры</th>
+                        </tr>
+                    </thead>
+                    <tbody>
+                        {% for t in top %}
+                        <tr>
+                            <td>{{ t.rank }}</td>
+                            <td><a href="/video/{{ t.video_id }}">{{ t.title }}</a></td>
+                            <td>{{ t.views }}</td>
+                        </tr>
+                        {% endfor %}
+                    </tbody>
+                </table>
+            </div>
+            
+            <div class="admin-section">
+                <h2><i class="far fa-calendar"></i> По дням</h2>
+                <table class="admin-table">
+                    <thead>
+                        <tr>
+                            <th>День</th>
+                            <th>Загрузки</th>
+                            <th>Комментарии</th>
+                            <th>Регистрации</th>
+                            <th>Баны</th>
+                            <th>Просмотры</th>
+                            <th>Время просмотра</th>
+                        </tr>
+                    </thead>
+                    <tbody>
+                        {% for d in days %}
+                        <tr>
+                            <td>{{ d.day.strftime('%d.%m.%Y') }}</td>
+                            <td>{{ d.uploads }}</td>
+                            <td>{{ d.comments }}</td>
+                            <td>{{ d.registrations }}</td>
+                            <td>{{ d.bans }}</td>
+                            <td>
+                                <div class="bar" style="width: {{ (100 * d.views / peak)|round|int }}%"></div>
+                                {{ d.views }}
+                            </td>
+                            <td>{{ (d.watch_seconds / 3600)|round(1) }} ч</td>
+                        </tr>
+                        {% endfor %}
+                    </tbody>
+                </table>
+            </div>
+        </div>
+    </div>
 </body>
 </html>
-    ''', videos=videos, users=users, comments=comments, user=user)  # ИСПРАВЛЕНО: добавлен user=user
+    '''
+
+@app.route('/admin/dashboard')
+def admin_dashboard():
+    user = current_user()
+    if not user or not user.is_admin:
+        return redirect('/')
+    
+    days = DailyRollup.query.order_by(DailyRollup.day.desc()).limit(app.config['DASHBOARD_DAYS']).all()
+    top = TopVideo.query.order_by(TopVideo.rank).all()
+    peak = max((d.views for d in days), default=0) or 1
+    
+    return render_template('admin_dashboard.html', days=days, top=top, peak=peak, user=user)
 
 # Админ действия
+# Модерация: каждое действие - один UPDATE по списку id или по условию, RETURNING отдаёт
+# только реально изменённые строки, по ним правятся счётчики и версии страниц
+def ban_users(user_ids):
+    banned = db.session.execute(update(User).where(User.id.in_(user_ids), User.is_admin == False,
+                                                   User.is_banned == False)
+                                .values(is_banned=True, banned_at=datetime.utcnow()).returning(User.id),
+                                execution_options={'synchronize_session': False}).scalars().all()
+    if not banned:
+        return 0
+    
+    # Удаляем все видео пользователей вместе с их комментариями и лайками:
+    # число запросов не зависит от количества видео
+    files = db.session.execute(select(Video.filename, Video.storage_tier).where(Video.user_id.in_(banned))).all()
+    video_ids = select(Video.id).where(Video.user_id.in_(banned))
+    for statement in (delete(Comment).where(Comment.video_id.in_(video_ids)),
+                      delete(Like).where(Like.video_id.in_(video_ids)),
+                      delete(ViewerSketch).where(ViewerSketch.video_id.in_(video_ids)),
+                      delete(Video).where(Video.user_id.in_(banned))):
+        db.session.execute(statement, execution_options={'synchronize_session': False})
+    db.session.execute(update(UserStats).where(UserStats.user_id.in_(banned)).values(video_count=0, total_views=0))
+    
+    bump_stamps('index', *(f'user:{user_id}' for user_id in banned))
+    db.session.commit()
+    
+    # Файлы - только после commit: при откате базы они ещё нужны
+    storage.delete_many(f.filename for f in files if video_storage(f) is storage)
+    if archive:
+        archive.delete_many(f.filename for f in files if video_storage(f) is archive)
+    return len(banned)
+
+def unban_users(user_ids):
+    unbanned = db.session.execute(update(User).where(User.id.in_(user_ids), User.is_banned == True)
+                                  .values(is_banned=False).returning(User.id),
+                                  execution_options={'synchronize_session': False}).scalars().all()
+    if unbanned:
+        bump_stamps('index', *(f'user:{user_id}' for user_id in unbanned))
+    return len(unbanned)
+
+def block_videos(video_ids, blocked):
+    changed = db.session.execute(update(Video).where(Video.id.in_(video_ids), Video.is_blocked != blocked)
+                                 .values(is_blocked=blocked).returning(Video.id, Video.user_id, Video.views),
+                                 execution_options={'synchronize_session': False}).all()
+    sign = -1 if blocked else 1
+    per_author = {}
+    for _, user_id, views in changed:
+        videos, total = per_author.get(user_id, (0, 0))
+        per_author[user_id] = (videos + sign, total + sign * views)
+    for user_id, (videos, views) in per_author.items():
+        adjust_stats(user_id, videos=videos, views=views)
+    if changed:
+        bump_stamps('index', *(f'video:{video_id}' for video_id, _, _ in changed),
+                    *(f'user:{user_id}' for user_id in per_author))
+    return len(changed)
+
+def block_comments(blocked, *criteria):
+    video_ids = db.session.execute(update(Comment).where(*criteria, Comment.is_blocked != blocked)
+                                   .values(is_blocked=blocked).returning(Comment.video_id),
+                                   execution_options={'synchronize_session': False}).scalars().all()
+    deltas = {}
+    for video_id in video_ids:
+        deltas[video_id] = deltas.get(video_id, 0) + (-1 if blocked else 1)
+    change_comment_counts(deltas)
+    bump_stamps(*(f'video:{video_id}' for video_id in deltas))
+    return len(video_ids)
+
 @app.route('/admin/ban/<int:user_id>')
 def ban_user(user_id):
     if not is_admin():
         return redirect('/')
     
-    user = User.query.get(user_id)
-    if user and not user.is_admin:
-        user.is_banned = True
-        
-        # Удаляем все видео пользователя
-        videos = Video.query.filter_by(user_id=user_id).all()
-        for video in videos:
-            # Удаляем файл видео
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], video.filename)
-            if os.path.exists(filepath):
-                os.remove(filepath)
-            # Удаляем из базы
-            db.session.delete(video)
-        
-        db.session.commit()
-    
+    ban_users([user_id])
     return redirect('/admin')
 
 @app.route('/admin/unban/<int:user_id>')
@@ -2182,11 +3085,8 @@ def unban_user(user_id):
     if not is_admin():
         return redirect('/')
     
-    user = User.query.get(user_id)
-    if user:
-        user.is_banned = False
-        db.session.commit()
-    
+    unban_users([user_id])
+    db.session.commit()
     return redirect('/admin')
 
 @app.route('/admin/block_video/<int:video_id>')
@@ -2194,11 +3094,8 @@ def block_video(video_id):
     if not is_admin():
         return redirect('/')
     
-    video = Video.query.get(video_id)
-    if video:
-        video.is_blocked = True
-        db.session.commit()
-    
+    block_videos([video_id], True)
+    db.session.commit()
     return redirect('/admin')
 
 @app.route('/admin/unblock_video/<int:video_id>')
@@ -2206,11 +3103,8 @@ def unblock_video(video_id):
     if not is_admin():
         return redirect('/')
     
-    video = Video.query.get(video_id)
-    if video:
-        video.is_blocked = False
-        db.session.commit()
-    
+    block_videos([video_id], False)
+    db.session.commit()
     return redirect('/admin')
 
 @app.route('/admin/block_comment/<int:comment_id>')
@@ -2218,11 +3112,8 @@ def block_comment(comment_id):
     if not is_admin():
         return redirect('/')
     
-    comment = Comment.query.get(comment_id)
-    if comment:
-        comment.is_blocked = True
-        db.session.commit()
-    
+    block_comments(True, Comment.id == comment_id)
+    db.session.commit()
     return redirect(request.referrer or '/admin')
 
 @app.route('/admin/unblock_comment/<int:comment_id>')
@@ -2230,13 +3121,300 @@ def unblock_comment(comment_id):
     if not is_admin():
         return redirect('/')
     
-    comment = Comment.query.get(comment_id)
-    if comment:
-        comment.is_blocked = False
+    block_comments(False, Comment.id == comment_id)
+    db.session.commit()
+    return redirect('/admin')
+
+# Массовая модерация из форм админки: action и список ids (для комментариев вместо ids
+# можно передать author - id пользователя, тогда действие применяется ко всем его комментариям)
+@app.route('/admin/bulk/users', methods=['POST'])
+def bulk_users():
+    if not is_admin():
+        return redirect('/')
+    
+    ids = request.form.getlist('ids', type=int)
+    action = request.form.get('action')
+    if action == 'ban':
+        ban_users(ids)
+    elif action == 'unban':
+        unban_users(ids)
         db.session.commit()
+    else:
+        abort(400)
+    return redirect('/admin')
+
+@app.route('/admin/bulk/videos', methods=['POST'])
+def bulk_videos():
+    if not is_admin():
+        return redirect('/')
+    
+    action = request.form.get('action')
+    if action not in ('block', 'unblock'):
+        abort(400)
+    block_videos(request.form.getlist('ids', type=int), action == 'block')
+    db.session.commit()
+    return redirect('/admin')
+
+@app.route('/admin/bulk/comments', methods=['POST'])
+def bulk_comments():
+    if not is_admin():
+        return redirect('/')
     
+    action = request.form.get('action')
+    if action not in ('block', 'unblock'):
+        abort(400)
+    author = request.form.get('author', type=int)
+    criteria = Comment.user_id == author if author else Comment.id.in_(request.form.getlist('ids', type=int))
+    block_comments(action == 'block', criteria)
+    db.session.commit()
     return redirect('/admin')
 
+# Команды
+@app.cli.command('init-db')
+def init_db_command():
+    """Создать недостающие таблицы, колонки, индексы и админа."""
+    init_db()
+    click.echo('База готова')
+
+@app.cli.command('build-icons')
+@click.argument('webfonts', type=click.Path(exists=True, file_okay=False))
+def build_icons(webfonts):
+    """Собрать подмножество шрифтов Font Awesome из папки webfonts и icons.css."""
+    # fonttools нужен только здесь: pip install fonttools brotli
+    from fontTools import subset
+
+    css = [
+        '/* Подмножество Font Awesome Free 6.4.0: шрифты SIL OFL 1.1, см. LICENSE-fontawesome.txt.',
+        '   Генерируется командой flask --app app build-icons, вручную не редактировать. */',
+    ]
+    for style, icons in ICONS.items():
+        source, family, weight = ICON_FONTS[style]
+        options = subset.Options()
+        options.flavor = 'woff2'
+        options.layout_features = []
+        font = subset.load_font(os.path.join(webfonts, source), options)
+        subsetter = subset.Subsetter(options)
+        subsetter.populate(unicodes=[int(code, 16) for code in icons.values()])
+        subsetter.subset(font)
+        subset.save_font(font, os.path.join(ASSETS_FOLDER, f'icons-{style}.woff2'), options)
+        css.append(f"@font-face {{ font-family: '{family}'; font-style: normal; font-weight: {weight}; "
+                   f"font-display: block; src: url(icons-{style}.woff2) format('woff2'); }}")
+
+    css.append('.fas, .far, .fab { -moz-osx-font-smoothing: grayscale; -webkit-font-smoothing: antialiased; '
+               'display: inline-block; font-style: normal; font-variant: normal; line-height: 1; text-rendering: auto; }')
+    for style, prefix in (('solid', 'fas'), ('regular', 'far'), ('brands', 'fab')):
+        _, family, weight = ICON_FONTS[style]
+        css.append(f".{prefix} {{ font-family: '{family}'; font-weight: {weight}; }}")
+    codes = {name: code for icons in ICONS.values() for name, code in icons.items()}
+    for name in sorted(codes):
+        css.append(f'.fa-{name}::before {{ content: "\\{codes[name]}"; }}')
+
+    with open(os.path.join(ASSETS_FOLDER, 'icons.css'), 'w') as f:
+        f.write('\n'.join(css) + '\n')
+    click.echo(f'Иконок: {len(codes)}')
+
+@app.cli.command('shard-videos')
+@click.option('--batch', default=500)
+def shard_videos_command(batch):
+    """Разложить старые видео из плоского UPLOAD_FOLDER по каталогам ab/cd/."""
+    if not isinstance(storage, LocalStorage):
+        raise click.ClickException('Перенос нужен только для локального хранилища')
+    moved = missing = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(select(Video.id, Video.filename, Video.storage_tier)
+                                  .where(Video.id > last_id, Video.filename.not_like('%/%'))
+                                  .order_by(Video.id).limit(batch)).all()
+        if not rows:
+            break
+        changes = []
+        for row in rows:
+            key = shard_key(row.filename)
+            # Видео могло уже уйти в архив - ищем файл на его уровне
+            tier = video_storage(row)
+            old_path, new_path = tier.path(row.filename), tier.path(key)
+            if os.path.exists(old_path):
+                os.makedirs(os.path.dirname(new_path), exist_ok=True)
+                os.replace(old_path, new_path)
+            elif not os.path.exists(new_path):
+                # Файла нет ни там, ни там - строку не трогаем, её найдёт sweep-uploads
+                missing += 1
+                continue
+            # Повторный запуск после сбоя: файл уже перенесён, осталось обновить строку
+            changes.append({'id': row.id, 'filename': key})
+        if changes:
+            db.session.execute(update(Video), changes)
+            db.session.commit()
+        moved += len(changes)
+        last_id = rows[-1][0]
+        click.echo(f'Перенесено: {moved}')
+    click.echo(f'Готово: {moved} видео, файлов не найдено: {missing}')
+
+@app.cli.command('rebalance-storage')
+def rebalance_storage_command():
+    """Заполнить размеры видео и перенести холодные видео в архив."""
+    rebalance_storage(log=click.echo)
+
+@app.cli.command('aggregate-events')
+def aggregate_events_command():
+    """Добавить новые закрытые сегменты журнала событий в дневные сводки."""
+    total, _ = aggregate_events(log=click.echo)
+    click.echo(f'Готово, событий: {total}')
+
+@app.cli.command('rollup')
+def rollup_command():
+    """Досчитать дневные сводки и популярные видео для панели администратора."""
+    build_rollups(log=click.echo)
+
+@app.cli.command('sweep-uploads')
+@click.option('--delete', 'remove', is_flag=True, help='удалить лишние файлы, иначе только отчёт')
+@click.option('--batch', default=1000)
+@click.option('--rate', default=2000, help='файловых операций в секунду')
+def sweep_uploads_command(remove, batch, rate):
+    """Найти файлы без видео и видео без файлов в хранилище."""
+    try:
+        run = sweep_uploads(remove, batch, rate, log=click.echo)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'Просмотрено файлов: {run.scanned}, лишних: {run.orphans} ({run.orphan_bytes // (1024 * 1024)} МБ), '
+               f'освобождено: {run.reclaimed_bytes // (1024 * 1024)} МБ, видео без файлов: {run.missing}')
+
+@app.cli.command('reconcile-comment-counts')
+@click.option('--batch', default=1000)
+def reconcile_comment_counts_command(batch):
+    """Пересчитать Video.comment_count (после обновления схемы и для проверки)."""
+    fixed = reconcile_comment_counts(batch, log=click.echo)
+    click.echo(f'Готово, исправлено: {fixed}')
+
+# Генерация тестовых данных
+def stub_mp4():
+    # Минимальный корректный MP4: ftyp + moov с пустым mvhd
+    ftyp = struct.pack('>I4s4sI4s4s', 24, b'ftyp', b'isom', 0x200, b'isom', b'mp41')
+    mvhd = struct.pack('>I4sIIIII', 108, b'mvhd', 0, 0, 0, 1000, 0)
+    mvhd += struct.pack('>IH10x9I24xI', 0x00010000, 0x0100, 0x00010000, 0, 0, 0, 0x00010000, 0, 0, 0, 0x40000000, 1)
+    return ftyp + struct.pack('>I4s', 8 + len(mvhd), b'moov') + mvhd
+
+def zipf_weights(n, s):
+    return list(itertools.accumulate(1 / rank ** s for rank in range(1, n + 1)))
+
+def bulk_insert(model, columns, rows, batch):
+    # PostgreSQL + psycopg2: COPY, иначе executemany пачками
+    table = model.__table__
+    total = 0
+    use_copy = db.engine.dialect.name == 'postgresql' and db.engine.dialect.driver == 'psycopg2'
+    while True:
+        chunk = list(itertools.islice(rows, batch))
+        if not chunk:
+            return total
+        if use_copy:
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows([[row[c] for c in columns] for row in chunk])
+            buffer.seek(0)
+            cursor = db.session.connection().connection.cursor()
+            cursor.copy_expert(f'COPY "{table.name}" ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)', buffer)
+        else:
+            db.session.execute(insert(table), chunk)
+        db.session.commit()
+        total += len(chunk)
+
+def generate_dataset(users, videos, comments, likes, seed=1, prefix='user', password='password',
+                     skew=1.1, days=365, batch=10000, files=True, log=lambda msg: None):
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+
+    started = time.perf_counter()
+    password_hash = generate_password_hash(password)
+    # created_at задаём явно: COPY не применяет значения по умолчанию из модели
+    n = bulk_insert(User, ['username', 'password_hash', 'is_admin', 'is_banned', 'created_at'],
+                    ({'username': f'{prefix}{i}', 'password_hash': password_hash, 'is_admin': False, 'is_banned': False,
+                      'created_at': now - timedelta(seconds=rng.randrange(days * 86400))}
+                     for i in range(users)), batch)
+    log(f'Пользователи: {n} за {time.perf_counter() - started:.1f} с')
+    user_ids = db.session.execute(select(User.id).where(User.username.like(f'{prefix}%'))
+                                  .order_by(User.id)).scalars().all()
+
+    # Авторы тоже по Ципфу: несколько активных каналов и длинный хвост
+    started = time.perf_counter()
+    author_weights = zipf_weights(len(user_ids), skew)
+    view_ranks = list(range(1, videos + 1))
+    rng.shuffle(view_ranks)
+    folder = app.config['UPLOAD_FOLDER']
+    stub_path = os.path.join(folder, '.stub.mp4')
+    if files:
+        with open(stub_path, 'wb') as f:
+            f.write(stub_mp4())
+
+    def video_rows():
+        for i in range(videos):
+            filename = shard_key('%032x.mp4' % rng.getrandbits(128))
+            if files:
+                os.makedirs(os.path.dirname(os.path.join(folder, filename)), exist_ok=True)
+                # Жёсткие ссылки на одну заглушку: миллионы файлов без расхода места
+                try:
+                    os.link(stub_path, os.path.join(folder, filename))
+                except OSError:
+                    with open(os.path.join(folder, filename), 'wb') as f:
+                        f.write(stub_mp4())
+            yield {'title': f'Видео {i}', 'filename': filename,
+                   'user_id': rng.choices(user_ids, cum_weights=author_weights)[0],
+                   'views': int(1_000_000 / view_ranks[i] ** skew), 'is_blocked': False,
+                   'created_at': now - timedelta(seconds=rng.randrange(days * 86400)),
+                   'size_bytes': len(stub_mp4()), 'storage_tier': 'hot', 'recent_views': 0}
+
+    first_video = (db.session.query(db.func.max(Video.id)).scalar() or 0) + 1
+    n = bulk_insert(Video, ['title', 'filename', 'user_id', 'views', 'is_blocked', 'created_at',
+                            'size_bytes', 'storage_tier', 'recent_views'], video_rows(), batch)
+    if files:
+        os.remove(stub_path)
+    log(f'Видео: {n} за {time.perf_counter() - started:.1f} с')
+    video_ids = db.session.execute(select(Video.id).where(Video.id >= first_video)
+                                   .order_by(Video.id)).scalars().all()
+
+    # Комментарии и лайки сосредоточены на популярных видео (те же ранги, что и у просмотров)
+    hot_videos = [video_id for _, video_id in sorted(zip(view_ranks, video_ids))]
+    video_weights = zipf_weights(len(hot_videos), skew)
+
+    started = time.perf_counter()
+    n = bulk_insert(Comment, ['content', 'user_id', 'video_id', 'is_blocked', 'created_at'],
+                    ({'content': f'Комментарий {i}', 'user_id': rng.choice(user_ids),
+                      'video_id': rng.choices(hot_videos, cum_weights=video_weights)[0], 'is_blocked': False,
+                      'created_at': now - timedelta(seconds=rng.randrange(days * 86400))}
+                     for i in range(comments)), batch)
+    reconcile_comment_counts(batch)
+    log(f'Комментарии: {n} за {time.perf_counter() - started:.1f} с')
+
+    started = time.perf_counter()
+    n = bulk_insert(Like, ['user_id', 'video_id', 'is_like'],
+                    ({'user_id': rng.choice(user_ids), 'video_id': rng.choices(hot_videos, cum_weights=video_weights)[0],
+                      'is_like': rng.random() < 0.9} for _ in range(likes)), batch)
+    log(f'Лайки: {n} за {time.perf_counter() - started:.1f} с')
+    bump_stamps('index')
+    db.session.commit()
+
+@app.cli.command('generate-data')
+@click.option('--users', default=1000)
+@click.option('--videos', default=10000)
+@click.option('--comments', default=100000)
+@click.option('--likes', default=100000)
+@click.option('--seed', default=1)
+@click.option('--prefix', default='user', help='префикс имён пользователей')
+@click.option('--password', default='password', help='пароль всех сгенерированных пользователей')
+@click.option('--skew', default=1.1, help='показатель распределения Ципфа')
+@click.option('--batch', default=10000)
+@click.option('--no-files', is_flag=True, help='не создавать файлы-заглушки в UPLOAD_FOLDER')
+def generate_data_command(users, videos, comments, likes, seed, prefix, password, skew, batch, no_files):
+    """Наполнить базу синтетическими пользователями, видео, комментариями и лайками."""
+    init_db()
+    generate_dataset(users, videos, comments, likes, seed=seed, prefix=prefix, password=password,
+                     skew=skew, batch=batch, files=not no_files, log=click.echo)
+
+def warm_up():
+    # При preload_app выполняется в мастере gunicorn, воркеры получают всё готовым
+    for name in TEMPLATES:
+        app.jinja_env.get_template(name)
+
+warm_up()
+
 if __name__ == '__main__':
     # Для Render используем порт из окружения
     port = int(os.environ.get('PORT', 5000))
@@ -0,0 +1,301 @@
+"""Нагрузочный бенчмарк основных маршрутов Pixtube.
+
+Создаёт временную базу заданного размера, поднимает gunicorn и по очереди
+нагружает /, /video/<id>, /comment/<id>, /upload и /admin. Результат
+(p50/p95/p99, пропускная способность, RSS воркеров) пишется в JSON.
+
+    python bench.py --users 1000 --videos 5000 --workers 4 --duration 15
+    python bench.py --compare bench_results/old.json bench_results/new.json
+    python bench.py --hll    # точность и память счётчика уникальных зрителей
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+ROUTES = ['index', 'video', 'comment', 'upload', 'admin']
+PASSWORD = 'bench'
+STUB_VIDEO = b'\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom' + b'\x00' * 1000
+BATCH = 10000
+
+
+def seed_database(args):
+    # Импортируем приложение только после того, как окружение указало на временную базу
+    from app import app, db, Video, generate_dataset, init_db
+
+    with app.app_context():
+        init_db()
+        generate_dataset(args.users, args.videos, args.comments, args.likes, seed=args.seed,
+                         prefix='bench', password=PASSWORD, batch=BATCH, log=print)
+        return db.session.execute(db.select(Video.id)).scalars().all()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, env, port):
+    proc = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '-w', str(args.workers),
+                             '-b', f'127.0.0.1:{port}',
+                             '--log-level', 'warning', 'app:app'], cwd=ROOT, env=env)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/login')
+            conn.getresponse().read()
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError('gunicorn не поднялся за 30 секунд')
+
+
+def login(port, username, password):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('POST', '/login', body=f'username={username}&password={password}',
+                 headers={'Content-Type': 'application/x-www-form-urlencoded'})
+    response = conn.getresponse()
+    response.read()
+    return response.getheader('Set-Cookie').split(';')[0]
+
+
+def multipart(fields, files):
+    boundary = 'benchboundary'
+    body = b''
+    for name, value in fields.items():
+        body += f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+    for name, (filename, data) in files.items():
+        body += (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                 f'Content-Type: video/mp4\r\n\r\n').encode() + data + b'\r\n'
+    body += f'--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+def make_request(route, rng, video_ids, cookies):
+    if route == 'index':
+        return 'GET', '/', None, {}
+    if route == 'video':
+        return 'GET', f'/video/{rng.choice(video_ids)}', None, {}
+    if route == 'comment':
+        return ('POST', f'/comment/{rng.choice(video_ids)}', 'content=bench',
+                {'Content-Type': 'application/x-www-form-urlencoded', 'Cookie': cookies['user']})
+    if route == 'upload':
+        body, content_type = multipart({'title': 'bench'}, {'video': ('bench.mp4', STUB_VIDEO)})
+        return 'POST', '/upload', body, {'Content-Type': content_type, 'Cookie': cookies['user']}
+    return 'GET', '/admin', None, {'Cookie': cookies['admin']}
+
+
+def run_route(route, args, port, video_ids, cookies):
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+
+    def worker(n):
+        rng = random.Random(args.seed * 1000 + n)
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        local = []
+        while time.perf_counter() < deadline:
+            method, path, body, headers = make_request(route, rng, video_ids, cookies)
+            started = time.perf_counter()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                if response.status >= 400:
+                    with lock:
+                        errors[0] += 1
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                with lock:
+                    errors[0] += 1
+                continue
+            local.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+
+    def percentile(p):
+        return round(latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000, 2) if latencies else None
+
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+    }
+
+
+def worker_rss(master_pid):
+    # RSS воркеров gunicorn (дочерних процессов мастера), только Linux
+    rss = {}
+    if not os.path.isdir('/proc'):
+        return rss
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                status = dict(line.split(':', 1) for line in f if ':' in line)
+        except OSError:
+            continue
+        if status.get('PPid', '').strip() == str(master_pid) and 'VmRSS' in status:
+            rss[pid] = int(status['VmRSS'].split()[0])
+    return rss
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run(args):
+    tmp = tempfile.mkdtemp(prefix='pixtube-bench-')
+    env = dict(os.environ,
+               DATABASE_URL=f'sqlite:///{os.path.join(tmp, "bench.db")}',
+               UPLOAD_FOLDER=os.path.join(tmp, 'videos'),
+               SHARED_STATE_DB=os.path.join(tmp, 'shared.db'),
+               EVENT_LOG_DIR=os.path.join(tmp, 'events'),
+               RATE_LIMIT_ENABLED='0')
+    env.pop('RENDER', None)
+    os.environ.update(env)
+
+    print(f'Наполняю базу в {tmp}...')
+    started = time.perf_counter()
+    video_ids = seed_database(args)
+    seed_seconds = time.perf_counter() - started
+
+    port = free_port()
+    server = start_server(args, env, port)
+    try:
+        cookies = {'user': login(port, 'bench0', PASSWORD), 'admin': login(port, 'admin', 'admin')}
+        routes, rss_kb = {}, {}
+        for route in args.routes:
+            print(f'{route}: {args.duration} с, {args.concurrency} потоков...')
+            routes[route] = run_route(route, args, port, video_ids, cookies)
+            for pid, kb in worker_rss(server.pid).items():
+                rss_kb[pid] = max(rss_kb.get(pid, 0), kb)
+            print('   ', routes[route])
+    finally:
+        server.terminate()
+        server.wait()
+
+    result = {
+        'commit': git_commit(),
+        'date': datetime.utcnow().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'params': {k: getattr(args, k) for k in ('users', 'videos', 'comments', 'likes', 'workers',
+                                                  'concurrency', 'duration', 'seed')},
+        'seed_seconds': round(seed_seconds, 2),
+        'routes': routes,
+        'worker_rss_kb': sorted(rss_kb.values()),
+    }
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, f'{datetime.utcnow():%Y%m%d-%H%M%S}-{result["commit"]}.json')
+    with open(path, 'w') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f'Результат: {path}')
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    if old['params'] != new['params']:
+        print('Внимание: параметры прогонов отличаются')
+    print(f'{"маршрут":<10}{"метрика":<16}{old["commit"]:>12}{new["commit"]:>12}{"изм.":>10}')
+    for route in new['routes']:
+        if route not in old['routes']:
+            continue
+        for key in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms'):
+            a, b = old['routes'][route][key], new['routes'][route][key]
+            change = f'{(b - a) / a * 100:+.1f}%' if a and b is not None else '-'
+            print(f'{route:<10}{key:<16}{a!s:>12}{b!s:>12}{change:>10}')
+    print(f'{"rss":<10}{"max_kb":<16}{max(old["worker_rss_kb"], default=0):>12}{max(new["worker_rss_kb"], default=0):>12}')
+
+
+def hll_benchmark(args):
+    # Сервер и база не нужны, но импорт приложения создаёт свои папки - уводим во временную
+    tmp = tempfile.mkdtemp(prefix='pixtube-bench-')
+    os.environ.update(DATABASE_URL=f'sqlite:///{os.path.join(tmp, "bench.db")}',
+                      UPLOAD_FOLDER=os.path.join(tmp, 'videos'), SHARED_STATE_DB=os.path.join(tmp, 'shared.db'),
+                      EVENT_LOG_DIR=os.path.join(tmp, 'events'))
+    os.environ.pop('RENDER', None)
+    from app import HyperLogLog
+
+    print(f'Регистров: {HyperLogLog.M}; на видео в базе {HyperLogLog.M} байт, '
+          f'в памяти воркера {sys.getsizeof(HyperLogLog().registers)} байт')
+    print(f'Стандартная ошибка по теории: {1.04 / math.sqrt(HyperLogLog.M):.2%}')
+    print(f'{"зрителей":>10}{"ср. ошибка":>12}{"макс.":>10}{"точное множество":>20}')
+    rng = random.Random(args.seed)
+    for n in (10, 100, 1000, 10000, 100000):
+        errors = []
+        for _ in range(args.hll_trials):
+            viewers = [f'u{rng.getrandbits(64)}' for _ in range(n)]
+            # Четыре «воркера» с пересекающимися потоками, потом слияние
+            parts = [HyperLogLog() for _ in range(4)]
+            for i, viewer in enumerate(viewers + viewers[:n // 2]):
+                parts[i % 4].add(viewer)
+            merged = parts[0]
+            for part in parts[1:]:
+                merged.merge(part)
+            errors.append(abs(merged.count() - n) / n)
+        exact = sys.getsizeof(set(viewers)) + sum(sys.getsizeof(v) for v in viewers)
+        print(f'{n:>10}{sum(errors) / len(errors):>12.2%}{max(errors):>10.2%}{exact:>18} Б')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк маршрутов Pixtube')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--videos', type=int, default=1000)
+    parser.add_argument('--comments', type=int, default=5000)
+    parser.add_argument('--likes', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=2, help='воркеры gunicorn')
+    parser.add_argument('--concurrency', type=int, default=8, help='одновременные клиенты')
+    parser.add_argument('--duration', type=float, default=10, help='секунд на маршрут')
+    parser.add_argument('--routes', nargs='+', choices=ROUTES, default=ROUTES)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', default=os.path.join(ROOT, 'bench_results'))
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='сравнить два JSON с результатами')
+    parser.add_argument('--hll', action='store_true', help='проверить точность и память HyperLogLog')
+    parser.add_argument('--hll-trials', type=int, default=5)
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+    elif args.hll:
+        hll_benchmark(args)
+    else:
+        run(args)
+
+
+if __name__ == '__main__':
+    main()
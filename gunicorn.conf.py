@@ -0,0 +1,25 @@
+# Запуск: gunicorn -c gunicorn.conf.py app:app
+# Приложение импортируется один раз в мастере (шаблоны и ресурсы уже готовы),
+# воркеры получают его через fork и стартуют без повторного импорта
+import os
+
+preload_app = True
+
+# Поток на соединение: открытые SSE-потоки (/video/<id>/events) не занимают весь воркер.
+# Их не больше четверти потоков (SSE_MAX_STREAMS), остальные зрители получают новые
+# комментарии опросом, так что обычные запросы всегда находят свободный поток
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+
+
+def post_fork(server, worker):
+    from app import app, db, worker_started
+    worker_started()
+    # Соединения из пула мастера воркеру не годятся
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def post_worker_init(worker):
+    from app import worker_ready
+    worker_ready()